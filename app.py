@@ -1,10 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from pymongo import MongoClient
-from flask_bcrypt import Bcrypt
-from datetime import datetime
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory, abort
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, InsertOne, UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError, ConnectionFailure
+from datetime import datetime, timedelta
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from dotenv import load_dotenv
+import click
+from passwords import PasswordHasher, HashingBusy
+import assets
+import metrics
+from mongo import MongoConnection, client_options_from_env
+import sessions
+from pagecache import PageCache
+from throttle import TokenBucketStore, Limit
+from symptom_search import SymptomSearch
+from knowledge import KnowledgeBase
+from chat import AnswerCache, normalize_query, sse_event
+from writebehind import WriteBehindQueue
 import os
+import atexit
+import json
+import math
+import secrets
+import hashlib
+import re
+import io
+import csv
+import codecs
+import zlib
+from functools import lru_cache
+from dataclasses import dataclass
+from types import MappingProxyType
 
 # Load environment variables
 load_dotenv()
@@ -14,119 +40,384 @@ app = Flask(__name__)
 # Secret key from environment (used for sessions & security)
 app.secret_key = os.getenv("SECRET_KEY", "fallback_secret")
 
-bcrypt = Bcrypt(app)
+# Password hashing runs in a bounded process pool. The bcrypt cost is
+# BCRYPT_LOG_ROUNDS if set, otherwise calibrated once to BCRYPT_TARGET_MS and
+# stored in MongoDB so every worker uses the same cost (see shared_bcrypt_rounds).
+password_hasher = PasswordHasher(
+    workers=int(os.getenv("HASH_WORKERS", 0)) or None,
+    queue_depth=int(os.getenv("HASH_QUEUE_DEPTH")) if os.getenv("HASH_QUEUE_DEPTH") else None,
+    rounds=int(os.getenv("BCRYPT_LOG_ROUNDS", 0)) or None,
+    target_ms=float(os.getenv("BCRYPT_TARGET_MS", 250)),
+    shared_rounds=lambda calibrate: shared_bcrypt_rounds(calibrate)
+)
+
+
+# Per-route latency histograms on /metrics; requests slower than
+# SLOW_REQUEST_MS are also logged with their db/hashing/render breakdown
+metrics.init_app(app, slow_request_ms=float(os.getenv("SLOW_REQUEST_MS", 0)) or None)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def busy_response():
+    # Back-pressure: tell the client to retry instead of queueing forever
+    return 'The server is busy, please try again in a moment.', 503, {'Retry-After': '1'}
+
+
+# Login throttling: token buckets per client IP and per account, shared by
+# all workers on the host (see throttle.py). A bucket holds *_BURST attempts
+# and refills at *_PER_MINUTE; over the limit the request gets a 429 before
+# any database lookup or password check.
+login_throttle = TokenBucketStore(os.getenv("THROTTLE_PATH"), slots=int(os.getenv("THROTTLE_SLOTS", 4096)))
+THROTTLE_IP_LIMIT = Limit(int(os.getenv("THROTTLE_IP_BURST", 20)),
+                          float(os.getenv("THROTTLE_IP_PER_MINUTE", 10)))
+THROTTLE_ACCOUNT_LIMIT = Limit(int(os.getenv("THROTTLE_ACCOUNT_BURST", 5)),
+                               float(os.getenv("THROTTLE_ACCOUNT_PER_MINUTE", 2)))
+
+
+# Behind reverse proxies every request comes from the proxy's address, so
+# set TRUSTED_PROXIES to how many of them append to X-Forwarded-For; the
+# client is then the address the outermost one saw. Leave it at 0 when
+# clients connect directly, or they could pick their own address.
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", 0))
+
+
+def client_ip():
+    if TRUSTED_PROXIES:
+        forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',')
+                     if address.strip()]
+        if len(forwarded) >= TRUSTED_PROXIES:
+            return forwarded[-TRUSTED_PROXIES]
+    return request.remote_addr
+
+
+def throttled_response(endpoint, account):
+    # None when the attempt may go ahead
+    wait = login_throttle.take([
+        (f'{endpoint}:ip:{client_ip()}', THROTTLE_IP_LIMIT),
+        (f'{endpoint}:account:{account.strip().lower()}', THROTTLE_ACCOUNT_LIMIT),
+    ])
+    metrics.login_throttle.inc(endpoint, 'throttled' if wait else 'allowed')
+    if not wait:
+        return None
+    return 'Too many login attempts, please try again later.', 429, {'Retry-After': str(math.ceil(min(wait, 3600)))}
 
 # MongoDB Configuration (safe from .env)
+# The client is created per process on first use (see mongo.py); the
+# database is MONGO_DB, and pool size, timeouts, read preference and write
+# concern come from the other MONGO_* variables.
 mongo_uri = os.getenv("MONGO_URI")
-client = MongoClient(mongo_uri)
+mongo = MongoConnection(
+    mongo_uri, os.getenv("MONGO_DB", "flask_auth"),
+    options=client_options_from_env(),
+    event_listeners=[metrics.MongoCommandTimer()],
+    on_connect=lambda: ensure_indexes()
+)
+
+users_collection = mongo.collection('users')
+appointments_collection = mongo.collection('appointments')
+slots_collection = mongo.collection('slots')
+sessions_collection = mongo.collection('sessions')
+rollups_collection = mongo.collection('appointment_rollups')
+chats_collection = mongo.collection('chats')
+settings_collection = mongo.collection('settings')
+
+metrics.registry.append(metrics.Gauge(
+    'mongodb_pool_connections', 'Connections in this process\'s MongoDB pool.', ('state',),
+    lambda: {('open',): mongo.pool_monitor.open, ('in_use',): mongo.pool_monitor.in_use}
+))
+metrics.registry.append(metrics.Gauge(
+    'mongodb_pool_checkout_failures', 'Failed connection checkouts since this process connected.', (),
+    lambda: {(): mongo.pool_monitor.checkout_failures}
+))
+
+# Where session data lives: 'cookie' (Flask's signed cookie), 'memory'
+# (per-process LRU, single worker) or 'mongo' (shared by all workers).
+# The server-side backends keep only an opaque session id in the cookie.
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "cookie")
+SESSION_TTL = timedelta(seconds=int(os.getenv("SESSION_TTL", 86400)))
+if SESSION_BACKEND == 'memory':
+    app.session_interface = sessions.ServerSideSessionInterface(
+        sessions.MemorySessionStore(max_entries=int(os.getenv("SESSION_MAX_ENTRIES", 10000))), SESSION_TTL)
+elif SESSION_BACKEND == 'mongo':
+    app.session_interface = sessions.ServerSideSessionInterface(
+        sessions.MongoSessionStore(sessions_collection), SESSION_TTL)
+
+def rotate_session():
+    # Call before recording a login. Server-side sessions move to a new id;
+    # the signed cookie backend has no id to fix, its cookie is rewritten
+    rotate = getattr(session, 'rotate', None)
+    if rotate is not None:
+        rotate()
+
+
+# How many bookings one test can take in the same date/time window.
+# Per-test overrides come from SLOT_CAPACITIES, e.g. '{"Genetic Tests": 2}'
+DEFAULT_SLOT_CAPACITY = int(os.getenv("SLOT_CAPACITY", 5))
+SLOT_CAPACITIES = json.loads(os.getenv("SLOT_CAPACITIES", "{}"))
+
+
+def shared_bcrypt_rounds(calibrate):
+    # The first process to calibrate stores its cost; the others, and later
+    # restarts, reuse it. Delete the document to calibrate again.
+    setting = settings_collection.find_one({'_id': 'bcrypt_rounds'})
+    if setting is None:
+        try:
+            setting = settings_collection.find_one_and_update(
+                {'_id': 'bcrypt_rounds'}, {'$setOnInsert': {'rounds': calibrate()}},
+                upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Another worker stored it first
+            setting = settings_collection.find_one({'_id': 'bcrypt_rounds'})
+    return setting['rounds']
+
+
+def ensure_indexes():
+    # Runs once per process when its MongoDB client is created;
+    # create_index is a no-op when the index already exists
+    users_collection.create_index([('email', ASCENDING)], unique=True)
+    appointments_collection.create_index([('date', ASCENDING), ('time', ASCENDING), ('test', ASCENDING)])
+    appointments_collection.create_index([('email', ASCENDING), ('created_at', DESCENDING)])
+    slots_collection.create_index([('test', ASCENDING), ('date', ASCENDING), ('time', ASCENDING)], unique=True)
+    rollups_collection.create_index([('kind', ASCENDING), ('key', ASCENDING)])
+    if SESSION_BACKEND == 'mongo':
+        sessions_collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+    if SESSION_BACKEND != 'memory':
+        chats_collection.create_index([('expires_at', ASCENDING)], expireAfterSeconds=0)
+
+
+# Capacity applies to SLOT_MINUTES-long windows, so with the default 30
+# every time from 10:00 to 10:29 books into the 10:00 slot
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", 30))
+
+
+def slot_time(time):
+    # Start of the window a HH:MM time falls in; ValueError for anything else
+    parsed = datetime.strptime(time, '%H:%M')
+    minutes = parsed.hour * 60 + parsed.minute
+    minutes -= minutes % SLOT_MINUTES
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def valid_slot(date, time):
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+        slot_time(time)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def slot_reservation(test, date, time):
+    # One conditional increment: it only matches while the slot has room.
+    # A full slot fails the filter, the upsert then collides with the unique
+    # index and we report it as taken, so concurrent workers can't overbook.
+    capacity = SLOT_CAPACITIES.get(test, DEFAULT_SLOT_CAPACITY)
+    return (
+        {'test': test, 'date': date, 'time': slot_time(time), 'booked': {'$lt': capacity}},
+        {'$inc': {'booked': 1}, '$set': {'capacity': capacity}}
+    )
+
+
+def slot_release(test, date, time):
+    return (
+        {'test': test, 'date': date, 'time': slot_time(time), 'booked': {'$gt': 0}},
+        {'$inc': {'booked': -1}}
+    )
+
+
+def reserve_slot(test, date, time):
+    query, update = slot_reservation(test, date, time)
+    try:
+        slot = slots_collection.find_one_and_update(query, update, upsert=True,
+                                                    return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        return False
+    return slot is not None
+
+
+def release_slot(test, date, time):
+    try:
+        query, update = slot_release(test, date, time)
+    except (TypeError, ValueError):
+        # Never reserved: bookings are validated before they take a slot
+        return
+    slots_collection.update_one(query, update)
+
+# Fingerprinted static assets (see assets.py, built with `flask build-assets`)
+ASSET_MAX_AGE = 31536000
+asset_manifest = assets.load_manifest()
+
+
+def index_built_assets(manifest):
+    # Every servable built file -> (encodings, webp sibling)
+    served = {}
+    for entry in manifest.values():
+        if 'encodings' in entry:
+            served[entry['path']] = (entry['encodings'], None)
+        for variant in entry.get('variants', {}).values():
+            served[variant['path']] = ([], variant['webp'])
+            served[variant['webp']] = ([], None)
+    return served
+
+
+built_assets = index_built_assets(asset_manifest)
+
+
+def asset_url_for(endpoint, **values):
+    # Drop-in for url_for in templates: static files that have been built
+    # resolve to their content-hashed copy, everything else is unchanged.
+    if endpoint == 'static' and values.get('filename') in asset_manifest:
+        entry = asset_manifest[values.pop('filename')]
+        return url_for('built_asset', filename=entry['path'], **values)
+    return url_for(endpoint, **values)
+
+
+def static_srcset(filename):
+    # "url 480w, url 960w, ..." for <img srcset>, empty before the first build
+    entry = asset_manifest.get(filename, {})
+    return ', '.join(
+        f"{url_for('built_asset', filename=variant['path'])} {width}w"
+        for width, variant in sorted(entry.get('variants', {}).items(), key=lambda item: int(item[0]))
+    )
+
+
+app.jinja_env.globals.update(url_for=asset_url_for, static_srcset=static_srcset)
+
+
+def listed_in(accept, value):
+    # Only an explicit entry counts: indexing an Accept header also matches
+    # wildcards like image/* or */*, and `in` is true even for "br;q=0"
+    return any(item.lower() == value and quality > 0 for item, quality in accept)
+
+
+@app.route('/assets/<path:filename>')
+def built_asset(filename):
+    if filename not in built_assets:
+        abort(404)
+    encodings, webp = built_assets[filename]
+    served_name = filename
+    headers = {'Cache-Control': f'public, max-age={ASSET_MAX_AGE}, immutable'}
+    mimetype = None
+
+    # Pick the precompressed or WebP copy the client can take
+    if encodings or webp:
+        headers['Vary'] = 'Accept-Encoding' if encodings else 'Accept'
+    for encoding in encodings:
+        if listed_in(request.accept_encodings, encoding):
+            served_name = filename + ('.br' if encoding == 'br' else '.gz')
+            headers['Content-Encoding'] = encoding
+            mimetype = 'text/css' if filename.endswith('.css') else 'text/javascript'
+            break
+    if webp and listed_in(request.accept_mimetypes, 'image/webp'):
+        served_name = webp
+
+    response = send_from_directory(assets.BUILD_DIR, served_name, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.headers.update(headers)
+    return response
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Build resized, WebP, hashed and precompressed static assets."""
+    manifest = assets.build_assets()
+    print(f'Built {len(manifest)} assets into {assets.BUILD_DIR}')
+
+
+# Rendered pages that look the same for every visitor
+page_cache = PageCache(os.path.join(app.root_path, app.template_folder),
+                       max_entries=int(os.getenv("PAGE_CACHE_SIZE", 256)))
 
-db = client['flask_auth']
-users_collection = db['users']
-appointments_collection = db['appointments']
 
 # Home Route
 @app.route('/')
+@page_cache.cached
 def home():
 
     return render_template ('home.html')
 @app.route('/home2')
+@page_cache.cached
 def home2():
     return render_template('home2.html')
 # About Route
-tests = {
-    "Blood Test": {
-        "purpose": "Check general health and detect diseases.",
-        "category": "Pathology",
-        "procedure": "Blood is drawn from a vein.",
-        "preparation": "Fast for 8-12 hours if required.",
-        "cost": "$50",
-        "duration": "10 minutes"
-    },
-    "X-Ray": {
-        "purpose": "Diagnose fractures and injuries.",
-        "category": "Radiology",
-        "procedure": "Images are taken using X-ray machines.",
-        "preparation": "Wear comfortable clothes. Remove metal objects.",
-        "cost": "$100",
-        "duration": "20 minutes"
-    },
-    "MRI Scan": {
-        "purpose": "Detailed images of organs and tissues.",
-        "category": "Radiology",
-        "procedure": "Lie still in a scanner for imaging.",
-        "preparation": "Avoid eating for 4 hours if required.",
-        "cost": "$500",
-        "duration": "45 minutes"
-    },
-    "CT Scan": {
-        "purpose": "Generate detailed cross-sectional images of the body.",
-        "category": "Radiology",
-        "procedure": "Lie on a table that slides into a CT scanner.",
-        "preparation": "May require fasting for a few hours.",
-        "cost": "$400",
-        "duration": "30 minutes"
-    },
-    "Urine Test": {
-        "purpose": "Detect infections, diseases, or other medical conditions.",
-        "category": "Pathology",
-        "procedure": "Provide a urine sample in a sterile container.",
-        "preparation": "Cleanse the area before providing the sample.",
-        "cost": "$20",
-        "duration": "5 minutes"
-    },
-    "Ultrasound": {
-        "purpose": "Visualize internal organs and structures.",
-        "category": "Radiology",
-        "procedure": "A gel is applied, and a probe is moved over the area.",
-        "preparation": "May need to drink water or fast beforehand.",
-        "cost": "$150",
-        "duration": "30 minutes"
-    },
-    "ECG (Electrocardiogram)": {
-        "purpose": "Measure the electrical activity of the heart.",
-        "category": "Cardiology",
-        "procedure": "Electrodes are attached to the skin to record activity.",
-        "preparation": "Avoid caffeine before the test.",
-        "cost": "$75",
-        "duration": "15 minutes"
-    },
-    "Allergy Test": {
-        "purpose": "Identify specific allergens causing reactions.",
-        "category": "Immunology",
-        "procedure": "Skin pricking or blood test is conducted.",
-        "preparation": "Avoid antihistamines for a few days prior.",
-        "cost": "$200",
-        "duration": "30 minutes"
-    },
-    "Liver Function Test": {
-        "purpose": "Assess the health and functionality of the liver.",
-        "category": "Pathology",
-        "procedure": "Blood sample is taken for analysis.",
-        "preparation": "Avoid eating or drinking for 8-10 hours.",
-        "cost": "$60",
-        "duration": "10 minutes"
-    },
-    "Thyroid Test": {
-        "purpose": "Check thyroid hormone levels.",
-        "category": "Endocrinology",
-        "procedure": "Blood sample is collected for testing.",
-        "preparation": "No specific preparation needed.",
-        "cost": "$40",
-        "duration": "10 minutes"
-    }
-}
 @app.route("/about")
+@page_cache.cached
 def about():
     return render_template("about.html")
 
 @app.route("/test_details")
+@page_cache.cached
 def test_details():
-    return render_template("testdetails.html", test_list=list(tests.keys()))
+    return render_template("testdetails.html", test_list=knowledge.snapshot().test_list)
+
+# Catalogue responses may be cached briefly by browsers, then revalidated by ETag
+CATALOGUE_MAX_AGE = 300
+
+
+def parse_number(text):
+    # "$50" -> 50.0, "10 minutes" -> 10.0
+    match = re.search(r'\d+(?:\.\d+)?', text or '')
+    return float(match.group()) if match else None
+
+
+def build_test_catalogue(tests):
+    # Parse the display strings once so filtering and sorting work on numbers
+    return tuple(
+        MappingProxyType(dict(details, name=name,
+                              cost_value=parse_number(details.get('cost')),
+                              duration_minutes=parse_number(details.get('duration'))))
+        for name, details in tests.items()
+    )
+
+
+def serialize(data):
+    # Bytes plus a strong ETag derived from them
+    body = json.dumps(data, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return body, hashlib.sha256(body).hexdigest()
+
+
+@lru_cache(maxsize=256)
+def catalogue_body(snapshot, category, min_cost, max_cost, sort):
+    # Keyed on the snapshot too, so a reload can never serve a stale body
+    entries = [
+        entry for entry in snapshot.test_catalogue
+        if (not category or entry['category'].lower() == category)
+        and (min_cost is None or (entry['cost_value'] or 0) >= min_cost)
+        and (max_cost is None or (entry['cost_value'] or 0) <= max_cost)
+    ]
+    if sort in ('cost_value', 'duration_minutes', 'name'):
+        entries = sorted(entries, key=lambda entry: (entry[sort] is None, entry[sort]))
+    return serialize([dict(entry) for entry in entries])
+
+
+def cached_json_response(body, etag):
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={CATALOGUE_MAX_AGE}'
+    return response.make_conditional(request)
+
 
 @app.route("/get_test_details/<test_name>")
 def get_test_details(test_name):
-    details = tests.get(test_name, {})
-    return jsonify(details)
+    body, etag = knowledge.snapshot().test_detail_bodies.get(test_name) or serialize({})
+    return cached_json_response(body, etag)
+
+
+@app.route("/api/tests")
+def test_catalogue_api():
+    # Whole catalogue in one response, optionally filtered:
+    # ?category=Radiology&min_cost=50&max_cost=200&sort=cost_value
+    body, etag = catalogue_body(
+        knowledge.snapshot(),
+        request.args.get('category', '').strip().lower(),
+        request.args.get('min_cost', type=float),
+        request.args.get('max_cost', type=float),
+        request.args.get('sort', '')
+    )
+    return cached_json_response(body, etag)
 
     
 
@@ -152,10 +443,29 @@ def login():
     if request.method == 'POST':
         email = request.form['email']
         password = request.form['password']
+        throttled = throttled_response('login', email)
+        if throttled:
+            return throttled
 
         # Check if user exists in the database
         user = users_collection.find_one({'email': email})
-        if user and bcrypt.check_password_hash(user['password'], password):
+        try:
+            with metrics.timed('hashing'):
+                valid = user is not None and password_hasher.check(user['password'], password)
+        except HashingBusy:
+            return busy_response()
+        # Upgrade hashes made with an old cost factor while we have the
+        # password; when the pool is busy it waits for a later login
+        if valid and password_hasher.needs_rehash(user['password']):
+            try:
+                with metrics.timed('hashing'):
+                    new_hash = password_hasher.hash(password)
+            except HashingBusy:
+                new_hash = None
+            if new_hash:
+                users_collection.update_one({'_id': user['_id']}, {'$set': {'password': new_hash}})
+        if valid:
+            rotate_session()
             session['user'] = user['name']
             return redirect(url_for('home2', message="success"))  # Pass message as query parameter
         else:
@@ -173,14 +483,17 @@ def register():
         email = request.form['email']
         password = request.form['password']
         
-        # Check if email already exists
-        if users_collection.find_one({'email': email}):
+        # Hash password and save to MongoDB, the unique email index rejects duplicates
+        try:
+            with metrics.timed('hashing'):
+                hashed_password = password_hasher.hash(password)
+        except HashingBusy:
+            return busy_response()
+        try:
+            users_collection.insert_one({'name': name, 'email': email, 'password': hashed_password})
+        except DuplicateKeyError:
             flash('Email already registered. Try logging in!', 'warning')
             return redirect(url_for('login'))
-        
-        # Hash password and save to MongoDB
-        hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-        users_collection.insert_one({'name': name, 'email': email, 'password': hashed_password})
         flash('Registration successful! Please login.', 'success')
         return redirect(url_for('home2'))
     
@@ -232,42 +545,127 @@ def dashboard():
 @app.route('/book_appointment', methods=['POST'])
 def book_appointment():
     if 'user' in session:
-        name = session['user']
-        email = request.form['email']
-        date = request.form['date']
-        time = request.form['time']
-        test = request.form['test']
-        phone_number = request.form['phone_number']
-        description = request.form['description']
-        
-        # Store the appointment in the MongoDB appointments collection
-        appointments_collection.insert_one({
-            'name': name,
-            'email': email,
-            'date': date,
-            'time': time,
-            'test': test,
-            'phone_number': phone_number,
-            'description': description,
-            'created_at': datetime.now()
-        })
-
-        # Store appointment details in session for the thank-you page
-        session['appointment_details'] = {
-            'name': name,
-            'email': email,
-            'date': date,
-            'time': time,
-            'test': test,
-            'phone_number': phone_number,
-            'description': description
-        }
-
-        flash('Appointment booked successfully!', 'success')
-        return redirect(url_for('thank_you'))
+        details = appointment_from_form(session['user'], request.form)
+        if not valid_slot(details['date'], details['time']):
+            return invalid_slot_response()
+
+        # Reserve the slot first so a full time window never gets an appointment
+        if not reserve_slot(details['test'], details['date'], details['time']):
+            return slot_taken_response()
+
+        # Store the appointment in the MongoDB appointments collection, or
+        # hand it to the write-behind queue when that is enabled
+        appointment = dict(details, created_at=datetime.now())
+        if booking_queue is not None and booking_queue.put(dict(appointment, _id=ObjectId())):
+            return appointment_booked_response(details)
+        try:
+            appointments_collection.insert_one(appointment)
+        except Exception:
+            release_slot(details['test'], details['date'], details['time'])
+            raise
+        update_rollups([details], 1)
+        return appointment_booked_response(details)
     else:
         flash('You need to log in first!', 'danger')
         return redirect(url_for('thank_you'))
+
+
+# Shared by book_appointment and its async twin in asgi.py
+def appointment_from_form(name, form):
+    return {
+        'name': name,
+        'email': form['email'],
+        'date': form['date'],
+        'time': form['time'],
+        'test': form['test'],
+        'phone_number': form['phone_number'],
+        'description': form['description']
+    }
+
+
+def invalid_slot_response():
+    flash('Please choose a valid date and time.', 'warning')
+    return redirect(url_for('dashboard'))
+
+
+def slot_taken_response():
+    flash('That time slot is fully booked. Please choose another time.', 'warning')
+    return redirect(url_for('dashboard'))
+
+
+def appointment_booked_response(details):
+    # Store appointment details in session for the thank-you page
+    session['appointment_details'] = details
+    flash('Appointment booked successfully!', 'success')
+    return redirect(url_for('thank_you'))
+
+
+# Write-behind bookings (WRITE_BEHIND=1): the slot is still reserved before
+# the response, but the appointment itself is queued and written with
+# insert_many in batches of WRITE_BEHIND_BATCH, or after at most
+# WRITE_BEHIND_INTERVAL seconds. An appointment MongoDB keeps rejecting is
+# moved to WRITE_BEHIND_DEAD_LETTER after WRITE_BEHIND_MAX_ATTEMPTS tries
+# and its slot is released.
+# On shutdown unwritten appointments are spilled to WRITE_BEHIND_SPILL and
+# re-queued by the next worker to start.
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "").lower() in ('1', 'true', 'yes')
+
+
+def insert_appointments(appointments):
+    # Appointments carry their _id, so a batch retried after a partial write
+    # (or replayed from the spill file) only adds and counts what's missing
+    try:
+        appointments_collection.insert_many(appointments, ordered=False)
+        errors = []
+    except BulkWriteError as error:
+        errors = error.details.get('writeErrors', [])
+    failed = {e['index'] for e in errors}
+    update_rollups([a for i, a in enumerate(appointments) if i not in failed], 1)
+    if any(e.get('code') != 11000 for e in errors):
+        raise BulkWriteError({'writeErrors': [e for e in errors if e.get('code') != 11000]})
+
+
+booking_queue = None
+if WRITE_BEHIND:
+    booking_queue = WriteBehindQueue(
+        insert_appointments,
+        batch_size=int(os.getenv("WRITE_BEHIND_BATCH", 100)),
+        flush_interval=float(os.getenv("WRITE_BEHIND_INTERVAL", 0.5)),
+        max_pending=int(os.getenv("WRITE_BEHIND_MAX_PENDING", 10000)),
+        spill_path=os.getenv("WRITE_BEHIND_SPILL", os.path.join(app.root_path, 'write_behind_spill.jsonl')),
+        dead_letter_path=os.getenv(
+            "WRITE_BEHIND_DEAD_LETTER", os.path.join(app.root_path, 'write_behind_dead_letter.jsonl')),
+        max_attempts=int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", 5)),
+        retryable=(ConnectionFailure,),
+        # The booking was confirmed but never stored, so free its place
+        on_dead_letter=lambda appointment: release_slot(
+            appointment.get('test'), appointment.get('date'), appointment.get('time'))
+    )
+    atexit.register(booking_queue.close)
+    metrics.registry.append(metrics.Gauge(
+        'booking_write_behind',
+        'Appointments queued, being written and written, dead-lettered or otherwise lost, '
+        'and failed flushes in this worker.',
+        ('state',),
+        lambda: {(state,): value for state, value in booking_queue.status().items()
+                 if state in ('pending', 'in_flight', 'flushed', 'dead_lettered', 'lost', 'failed_flushes')}
+    ))
+
+
+@app.route('/admin/bookings/queue', methods=['GET', 'POST'])
+def booking_queue_status():
+    # GET: this worker's write-behind queue; POST: pick up any spill file
+    # and write everything out now
+    if 'admin' not in session:
+        flash('You need to log in as admin!', 'danger')
+        return redirect(url_for('admin_login'))
+    if booking_queue is None:
+        return jsonify({'enabled': False})
+    if request.method == 'POST':
+        booking_queue.start()
+        booking_queue.replay()
+        booking_queue.flush()
+    return jsonify(dict(booking_queue.status(), enabled=True))
     
 
 @app.route('/thank_you')
@@ -289,93 +687,48 @@ def logout():
     return redirect(url_for('home'))
 
 
+# Candidates returned per query, and the share of a symptom phrase's weight
+# a query has to match before that phrase counts; below it for every
+# phrase the answer is NO_DIAGNOSIS
+SYMPTOM_SEARCH_K = int(os.getenv("SYMPTOM_SEARCH_K", 5))
+SYMPTOM_MIN_SHARE = float(os.getenv("SYMPTOM_MIN_SHARE", 0.4))
+SYMPTOM_BATCH_LIMIT = 1000
+
+
+def rank_diseases(symptoms, k=None):
+    # [(disease, score), ...], best first
+    return knowledge.snapshot().symptom_search.search(symptoms, k or SYMPTOM_SEARCH_K)
+
+
+def rank_diseases_batch(symptom_list, k=None):
+    # Score many symptom strings with one matrix product
+    return knowledge.snapshot().symptom_search.search_batch(symptom_list, k or SYMPTOM_SEARCH_K)
+
+
+def describe_candidates(candidates):
+    return [
+        {'disease': disease, 'score': score,
+         'prevention': prevention_method(disease), 'tests': test_method(disease)}
+        for disease, score in candidates
+    ]
+
+
+NO_DIAGNOSIS = "Disease not identified. Please consult a doctor."
+
+
 def predict_disease(symptoms):
-    # Simple symptom to disease mapping
-    disease_dict = {
-  "fever cough": "Flu or Chest Infection",
-        "headache nausea": "Migraine",
-        "chest pain shortness of breath": "Heart Attack",
-        "stomach pain nausea": "Food Poisoning",
-        "fatigue weakness": "Anemia",
-        "rash joint pain": "Lupus",
-        "difficulty breathing wheezing": "Asthma",
-        "painful urination blood in urine": "Urinary Tract Infection",
-        "fever chills headache": "Malaria",
-        "abdominal pain yellow skin": "Hepatitis",
-        "joint pain swelling": "Rheumatoid Arthritis",
-        "nausea dizziness": "Vertigo",
-        "persistent cough weight loss": "Tuberculosis",
-        "bloody stool diarrhea": "Colorectal Cancer",
-        "blurry vision headaches": "Diabetes",
-        "swollen lymph nodes fever": "Lymphoma",
-        "severe headache stiff neck": "Meningitis",
-        "swelling in legs high blood pressure": "Kidney Disease",
-        "night sweats cough": "Pneumonia",
-        "yellowing of eyes dark urine": "Hepatitis",
-        "chronic back pain tingling": "Sciatica",
-        "sore throat swollen glands": "Strep Throat"
-    }
-    
-    symptoms = symptoms.lower().strip()
-    for symptom_key, disease in disease_dict.items():
-        if symptom_key in symptoms:
-            return disease
-    return "Disease not identified. Please consult a doctor."
+    candidates = rank_diseases(symptoms, 1)
+    if candidates:
+        return candidates[0][0]
+    return NO_DIAGNOSIS
 
 
 def prevention_method(disease):
-    prevention_dict = {
-       "Flu or Chest Infection": "Get vaccinated, avoid contact with sick individuals, wash hands regularly.",
-        "Migraine": "Maintain a regular sleep schedule, reduce stress, avoid known triggers.",
-        "Heart Attack": "Exercise regularly, eat a heart-healthy diet, avoid smoking.",
-        "Food Poisoning": "Wash hands before eating, avoid undercooked food, drink clean water.",
-        "Anemia": "Eat iron-rich foods, avoid caffeine with meals, take iron supplements if prescribed.",
-        "Lupus": "Manage stress, avoid sun exposure, take prescribed medications.",
-        "Asthma": "Avoid triggers, use prescribed inhalers, keep the airways open.",
-        "Urinary Tract Infection": "Drink plenty of water, practice good hygiene, urinate after interlab.",
-        "Malaria": "Use insect repellent, sleep under mosquito nets, take anti-malarial medications.",
-        "Hepatitis": "Get vaccinated, avoid sharing needles, avoid alcohol.",
-        "Rheumatoid Arthritis": "Take prescribed medications, exercise regularly, maintain a healthy weight.",
-        "Vertigo": "Avoid sudden head movements, stay hydrated, manage stress.",
-        "Tuberculosis": "Follow prescribed medication regimen, avoid contact with infected individuals, wear a mask.",
-        "Colorectal Cancer": "Get screened regularly, eat a high-fiber diet, exercise regularly.",
-        "Diabetes": "Maintain a healthy weight, exercise regularly, monitor blood sugar levels.",
-        "Lymphoma": "Consult a doctor for early detection, manage stress, avoid smoking.",
-        "Meningitis": "Get vaccinated, avoid close contact with infected individuals, practice good hygiene.",
-        "Kidney Disease": "Monitor blood pressure, stay hydrated, avoid excessive salt intake.",
-        "Pneumonia": "Get vaccinated, avoid smoking, practice good hygiene, stay away from infected individuals.",
-        "Sciatica": "Exercise regularly, maintain good posture, avoid heavy lifting.",
-        "Strep Throat": "Wash hands regularly, avoid close contact with infected individuals, finish prescribed antibiotics."
-    }
-    
-    return prevention_dict.get(disease, "Consult a healthcare professional for prevention tips.")
+    return knowledge.snapshot().prevention.get(disease, "Consult a healthcare professional for prevention tips.")
+
 
 def test_method(disease):
-    test_dict = {
-        "Flu or Chest Infection": "Rapid Influenza Diagnostic Test (RIDT), Chest X-ray, Sputum Culture",
-        "Migraine": "MRI, CT scan, Blood tests",
-        "Heart Attack": "Electrocardiogram (ECG), Blood tests (Troponin levels), Coronary Angiogram",
-        "Food Poisoning": "Stool Culture, Blood tests",
-        "Anemia": "Complete Blood Count (CBC), Iron studies",
-        "Lupus": "Antinuclear Antibody (ANA) test, Blood tests",
-        "Asthma": "Spirometry, Peak Flow Measurement, Blood tests",
-        "Urinary Tract Infection": "Urine Culture, Urinalysis",
-        "Malaria": "Blood Smear, Rapid Diagnostic Test (RDT)",
-        "Hepatitis": "Hepatitis B Surface Antigen (HBsAg), Hepatitis C Antibody Test",
-        "Rheumatoid Arthritis": "Rheumatoid Factor (RF), Anti-CCP Antibody Test, X-rays",
-        "Vertigo": "MRI, CT scan, Vestibular Testing",
-        "Tuberculosis": "Tuberculin Skin Test (TST), Chest X-ray, Sputum Culture",
-        "Colorectal Cancer": "Colonoscopy, Fecal Occult Blood Test (FOBT), Biopsy",
-        "Diabetes": "Fasting Blood Sugar Test, HbA1c Test, Oral Glucose Tolerance Test",
-        "Lymphoma": "Biopsy, Blood tests, PET scan, CT scan",
-        "Meningitis": "Lumbar Puncture (Spinal Tap), Blood Culture, CT scan",
-        "Kidney Disease": "Urinalysis, Kidney Function Tests (Creatinine, GFR), Ultrasound",
-        "Pneumonia": "Chest X-ray, Sputum Culture, Blood tests",
-        "Sciatica": "MRI, CT scan, X-ray",
-        "Strep Throat": "Rapid Antigen Test, Throat Culture"
-    }
-    
-    return test_dict.get(disease, "Consult a healthcare professional for the necessary test.")
+    return knowledge.snapshot().test_methods.get(disease, "Consult a healthcare professional for the necessary test.")
 
 
 @app.route('/symptoms', methods=['GET', 'POST'])
@@ -383,39 +736,56 @@ def symptoms():
     predicted_disease = None
     prevention = None
     test_methods = None
+    alternatives = []
     symptoms_input = session.get('symptoms_input', '')  # Retrieve previous input from session
 
     if request.method == 'POST':
         symptoms_input = request.form['symptoms']
         session['symptoms_input'] = symptoms_input  # Store input in session
-        predicted_disease = predict_disease(symptoms_input)
+        candidates = rank_diseases(symptoms_input)
+        predicted_disease = candidates[0][0] if candidates else NO_DIAGNOSIS
         prevention = prevention_method(predicted_disease)
         test_methods = test_method(predicted_disease)
-    
+        alternatives = describe_candidates(candidates[1:])
+
     return render_template(
         'symptoms.html',
         symptoms_input=symptoms_input,
         predicted_disease=predicted_disease,
         prevention=prevention,
-        test_methods=test_methods
+        test_methods=test_methods,
+        alternatives=alternatives
     )
 
-quiz_data = [
-    {"question": "Do you experience frequent headaches? Click on Yes or No", "id": "headache", "options": ["Yes", "No"]},
-    {"question": "Do you have a history of heart disease? Click on Yes or No", "id": "heart_disease", "options": ["Yes", "No"]},
-    {"question": "Do you exercise regularly? Click on Yes or No", "id": "exercise", "options": ["Yes", "No"]},
-    {"question": "Are you a smoker? Click on Yes or No", "id": "smoker", "options": ["Yes", "No"]},
-    {"question": "Do you experience shortness of breath? Click on Yes or No", "id": "breathing", "options": ["Yes", "No"]},
-    {"question": "Do you have any family history of diabetes? Click on Yes or No", "id": "family_diabetes", "options": ["Yes", "No"]},
-    {"question": "Do you have any digestive issues (e.g., bloating, pain)? Click on Yes or No", "id": "digestive_issues", "options": ["Yes", "No"]},
-]
+
+@app.route('/api/symptoms/search', methods=['GET', 'POST'])
+def symptom_search_api():
+    # GET ?q=...&k=5 for one query; POST {"queries": [...], "k": 5} scores
+    # a whole batch at once. Each candidate comes with its prevention tips
+    # and recommended tests.
+    payload = request.get_json(silent=True) if request.method == 'POST' else None
+    k = request.args.get('k', type=int) or (payload.get('k') if isinstance(payload, dict) else None)
+    diseases = len(knowledge.snapshot().symptom_search.diseases)
+    if k is not None and (not isinstance(k, int) or not 1 <= k <= diseases):
+        return jsonify({'error': f'k must be between 1 and {diseases}'}), 400
+
+    if request.method == 'GET':
+        query = request.args.get('q', '')
+        return jsonify({'query': query, 'candidates': describe_candidates(rank_diseases(query, k))})
+
+    queries = payload.get('queries') if isinstance(payload, dict) else payload
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        return jsonify({'error': 'expected a list of query strings'}), 400
+    if len(queries) > SYMPTOM_BATCH_LIMIT:
+        return jsonify({'error': f'at most {SYMPTOM_BATCH_LIMIT} queries per request'}), 413
+    return jsonify({'results': [describe_candidates(candidates) for candidates in rank_diseases_batch(queries, k)]})
 
 @app.route('/quiz', methods=['GET', 'POST'])
 def quiz():
     if request.method == 'POST':
         # Get user responses
         answers = {}
-        for question in quiz_data:
+        for question in knowledge.snapshot().quiz_data:
             answer = request.form.get(question['id'])
             answers[question['id']] = answer
         
@@ -427,37 +797,140 @@ def quiz():
         
         return render_template('result.html', recommended_tests=recommended_tests, answers=answers)
     
-    return render_template('quiz.html', quiz_data=quiz_data)
+    return render_template('quiz.html', quiz_data=knowledge.snapshot().quiz_data)
+
+
+# Quiz rules (data/quiz.json): a rule fires when all (or any) of its answers
+# match. They are compiled into a table with one entry per combination of
+# Yes/No answers (2 ** 7 = 128), so scoring a questionnaire is a single lookup.
+QUIZ_BATCH_LIMIT = 10000
+
+
+def answers_mask(answers, question_ids):
+    # Bit i is set when question i was answered "Yes"; anything else counts as "No"
+    mask = 0
+    for bit, question_id in enumerate(question_ids):
+        if answers.get(question_id) == 'Yes':
+            mask |= 1 << bit
+    return mask
+
+
+def unanswered(answers, question_ids):
+    # Questions without exactly "Yes" or "No"
+    return [question_id for question_id in question_ids if answers.get(question_id) not in ('Yes', 'No')]
+
+
+def compile_quiz_rules(rules, question_ids, default):
+    def matches(answers, conditions):
+        return [answers[question_id] == value for question_id, value in conditions.items()]
+
+    table = []
+    for mask in range(1 << len(question_ids)):
+        answers = {question_id: 'Yes' if mask >> bit & 1 else 'No'
+                   for bit, question_id in enumerate(question_ids)}
+        fired = [
+            rule['tests'] for rule in rules
+            if ('all' in rule and all(matches(answers, rule['all'])))
+            or ('any' in rule and any(matches(answers, rule['any'])))
+        ]
+        table.append(tuple(fired or default))
+    return tuple(table)
 
 
 def recommend_tests(answers):
-    tests = []
-    
-    # Heart-related tests
-    if answers['heart_disease'] == 'Yes' and answers['breathing'] == 'Yes':
-        tests.append("Electrocardiogram (ECG), Coronary Angiogram, Blood Tests (Cholesterol, Lipids)")
-    
-    # Headache-related tests
-    if answers['headache'] == 'Yes':
-        tests.append("MRI, CT scan, Blood Pressure Monitoring")
-    
-    # Diabetes-related tests
-    if answers['family_diabetes'] == 'Yes' or answers['exercise'] == 'No':
-        tests.append("Fasting Blood Sugar Test, HbA1c Test, Oral Glucose Tolerance Test")
-    
-    # Smoking-related tests
-    if answers['smoker'] == 'Yes':
-        tests.append("Chest X-ray, Spirometry, Blood tests (for Carbon Monoxide levels)")
-    
-    # Digestive issues-related tests
-    if answers['digestive_issues'] == 'Yes':
-        tests.append("Stool Culture, Endoscopy, Liver Function Tests")
-    
-    # General health check-up
-    if not tests:
-        tests.append("Complete Blood Count (CBC), Liver Function Test, Kidney Function Test")
-    
-    return tests
+    snapshot = knowledge.snapshot()
+    return list(snapshot.quiz_table[answers_mask(answers, snapshot.quiz_question_ids)])
+
+
+@app.route('/api/quiz/score', methods=['POST'])
+def score_quiz_batch():
+    # Body: a JSON list of {"question_id": "Yes"|"No", ...} objects,
+    # or {"submissions": [...]}; returns the recommendations in the same order.
+    # Every question must be answered, a missing answer isn't taken as "No".
+    payload = request.get_json(silent=True)
+    submissions = payload.get('submissions') if isinstance(payload, dict) else payload
+    if not isinstance(submissions, list) or not all(isinstance(item, dict) for item in submissions):
+        return jsonify({'error': 'expected a list of answer objects'}), 400
+    if len(submissions) > QUIZ_BATCH_LIMIT:
+        return jsonify({'error': f'at most {QUIZ_BATCH_LIMIT} submissions per request'}), 413
+    snapshot = knowledge.snapshot()
+    invalid = []
+    for index, answers in enumerate(submissions):
+        questions = unanswered(answers, snapshot.quiz_question_ids)
+        if questions:
+            invalid.append({'index': index, 'questions': questions})
+    if invalid:
+        return jsonify({'error': 'every question needs a "Yes" or "No" answer', 'invalid': invalid[:100]}), 400
+    return jsonify({'results': [snapshot.quiz_table[answers_mask(answers, snapshot.quiz_question_ids)]
+                                for answers in submissions]})
+
+
+# Knowledge base: the data/*.json files as one immutable snapshot (see
+# knowledge.py). Edits are picked up by every worker within
+# KNOWLEDGE_CHECK_INTERVAL seconds, without a restart.
+@dataclass(frozen=True, eq=False)
+class Knowledge:
+    # Hashed by identity, so a snapshot can key the catalogue_body cache
+    versions: MappingProxyType
+    prevention: MappingProxyType
+    test_methods: MappingProxyType
+    symptom_search: SymptomSearch
+    tests: MappingProxyType
+    test_list: tuple
+    test_catalogue: tuple
+    test_detail_bodies: MappingProxyType
+    quiz_data: tuple
+    quiz_question_ids: tuple
+    quiz_table: tuple
+
+
+def build_knowledge(data):
+    diseases = data['diseases']['diseases']
+    tests = {entry['name']: {key: value for key, value in entry.items() if key != 'name'}
+             for entry in data['test_catalogue']['tests']}
+    quiz = data['quiz']
+    quiz_data = tuple(MappingProxyType(dict(question, options=tuple(question['options'])))
+                      for question in quiz['questions'])
+    quiz_question_ids = tuple(question['id'] for question in quiz_data)
+    return Knowledge(
+        versions=MappingProxyType({name: content.get('version') for name, content in data.items()}),
+        prevention=MappingProxyType({disease['name']: disease['prevention'] for disease in diseases}),
+        test_methods=MappingProxyType({disease['name']: disease['tests'] for disease in diseases}),
+        symptom_search=SymptomSearch({phrase: disease['name']
+                                      for disease in diseases for phrase in disease['symptoms']},
+                                     min_share=SYMPTOM_MIN_SHARE),
+        tests=MappingProxyType({name: MappingProxyType(details) for name, details in tests.items()}),
+        test_list=tuple(tests),
+        test_catalogue=build_test_catalogue(tests),
+        test_detail_bodies=MappingProxyType({name: serialize(details) for name, details in tests.items()}),
+        quiz_data=quiz_data,
+        quiz_question_ids=quiz_question_ids,
+        quiz_table=compile_quiz_rules(quiz['rules'], quiz_question_ids, tuple(quiz['default_tests'])),
+    )
+
+
+def knowledge_reloaded(snapshot):
+    # Pages and catalogue bodies rendered from the previous snapshot
+    page_cache.clear()
+    catalogue_body.cache_clear()
+    chat_answers.clear()
+
+
+knowledge = KnowledgeBase(
+    os.path.join(app.root_path, 'data'), build_knowledge,
+    check_interval=float(os.getenv("KNOWLEDGE_CHECK_INTERVAL", 2)),
+    on_reload=[knowledge_reloaded]
+)
+
+
+@app.route('/admin/knowledge', methods=['GET', 'POST'])
+def admin_knowledge():
+    # GET: versions loaded in this worker; POST: reload the files now
+    if 'admin' not in session:
+        flash('You need to log in as admin!', 'danger')
+        return redirect(url_for('admin_login'))
+    reloaded = knowledge.reload(force=True) if request.method == 'POST' else False
+    return jsonify({'versions': dict(knowledge.current.versions), 'reloaded': reloaded})
 
 
 # ////admin/////
@@ -467,9 +940,12 @@ def admin_login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-
+        throttled = throttled_response('admin', username)
+        if throttled:
+            return throttled
 
         if username == "admin" and password == "admin123":
+            rotate_session()
             session['admin'] = True
             return redirect(url_for('admin_dashboard'))
         else:
@@ -477,17 +953,434 @@ def admin_login():
 
     return render_template('admin_login.html')
 
+# Rows per page on the admin dashboard tables
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 50))
+
+# Only the fields the dashboard tables show (never the password hash)
+USER_FIELDS = ['name', 'email']
+APPOINTMENT_FIELDS = ['email', 'date', 'time', 'test', 'phone_number', 'description', 'created_at']
+
+
+def keyset_page(collection, query, projection, before, page_size=None):
+    # Newest first, continuing below the last _id of the previous page,
+    # so every page is one bounded index scan instead of a skip over old rows.
+    page_size = page_size or ADMIN_PAGE_SIZE
+    if before:
+        query = dict(query, _id={'$lt': ObjectId(before)})
+    docs = list(collection.find(query, projection).sort('_id', -1).limit(page_size + 1))
+    next_before = str(docs[page_size - 1]['_id']) if len(docs) > page_size else None
+    return docs[:page_size], next_before
+
+
 @app.route('/admin/dashboard')
 def admin_dashboard():
     if 'admin' not in session:
         flash('You need to log in as admin!', 'danger')
         return redirect(url_for('admin_login'))
 
- 
-    users = users_collection.find()
-    appointments = appointments_collection.find()
+    filters = {
+        'date': request.args.get('date', '').strip(),
+        'test': request.args.get('test', '').strip(),
+        'email': request.args.get('email', '').strip(),
+    }
+    user_query = {'email': filters['email']} if filters['email'] else {}
+    appointment_query = {key: value for key, value in filters.items() if value}
+
+    try:
+        users, next_users = keyset_page(
+            users_collection, user_query, USER_FIELDS, request.args.get('users_before'))
+        appointments, next_appointments = keyset_page(
+            appointments_collection, appointment_query, APPOINTMENT_FIELDS,
+            request.args.get('appointments_before'))
+    except InvalidId:
+        flash('Invalid page cursor.', 'danger')
+        return redirect(url_for('admin_dashboard', **appointment_query))
+
+    # Next-page links keep the filters and the other table's position
+    args = request.args.to_dict()
+    next_users_url = next_appointments_url = None
+    if next_users:
+        next_users_url = url_for('admin_dashboard', **dict(args, users_before=next_users))
+    if next_appointments:
+        next_appointments_url = url_for('admin_dashboard', **dict(args, appointments_before=next_appointments))
+
+    return render_template('admin_dashboard.html', users=users, appointments=appointments,
+                           filters=filters, next_users_url=next_users_url,
+                           next_appointments_url=next_appointments_url,
+                           summary=rollup_summary())
+
+# Appointment rollups: counters per test, per day and per hour of the
+# appointment, plus a running total, with an estimated revenue from the
+# catalogue price. They are bumped on every booking and deletion, so the
+# analytics never scan the appointments collection.
+ROLLUP_KINDS = ('test', 'day', 'hour')
+
+
+def test_price(test):
+    # Booking form names are plural ("Blood Tests"), the catalogue's aren't
+    tests = knowledge.snapshot().tests
+    details = tests.get(test) or tests.get(test.rstrip('s')) if test else None
+    return parse_number(details['cost']) if details else 0.0
+
+
+def rollup_keys(appointment):
+    time = appointment.get('time') or ''
+    return {
+        'test': appointment.get('test') or 'unknown',
+        'day': appointment.get('date') or 'unknown',
+        'hour': time[:2] if len(time) >= 2 else 'unknown',
+        'total': 'all',
+    }
+
+
+def rollup_operations(appointments, sign):
+    # Fold a batch into one $inc per counter document
+    increments = {}
+    for appointment in appointments:
+        price = test_price(appointment.get('test'))
+        for kind, key in rollup_keys(appointment).items():
+            counter = increments.setdefault((kind, key), [0, 0.0])
+            counter[0] += sign
+            counter[1] += sign * price
+    return [
+        UpdateOne({'_id': f'{kind}:{key}'},
+                  {'$inc': {'count': count, 'revenue': revenue}, '$set': {'kind': kind, 'key': key}},
+                  upsert=True)
+        for (kind, key), (count, revenue) in increments.items()
+    ]
+
+
+def update_rollups(appointments, sign):
+    operations = rollup_operations(appointments, sign)
+    if operations:
+        rollups_collection.bulk_write(operations, ordered=False)
+
+
+def reconcile_rollups():
+    # Rebuild every counter from the appointments themselves. Group on the
+    # server by (test, date, hour) so only the distinct buckets come back.
+    pipeline = [{'$group': {
+        '_id': {'test': '$test', 'date': '$date', 'hour': {'$substrBytes': [{'$ifNull': ['$time', '']}, 0, 2]}},
+        'count': {'$sum': 1},
+    }}]
+    totals = {}
+    for bucket in appointments_collection.aggregate(pipeline, allowDiskUse=True):
+        group = bucket['_id']
+        appointment = {'test': group.get('test'), 'date': group.get('date'), 'time': group.get('hour')}
+        price = test_price(appointment['test'])
+        for kind, key in rollup_keys(appointment).items():
+            counter = totals.setdefault((kind, key), [0, 0.0])
+            counter[0] += bucket['count']
+            counter[1] += bucket['count'] * price
+
+    operations = [
+        ReplaceOne({'_id': f'{kind}:{key}'}, {'kind': kind, 'key': key, 'count': count, 'revenue': revenue},
+                   upsert=True)
+        for (kind, key), (count, revenue) in totals.items()
+    ]
+    if operations:
+        rollups_collection.bulk_write(operations, ordered=False)
+    rollups_collection.delete_many({'_id': {'$nin': [f'{kind}:{key}' for kind, key in totals]}})
+    return len(operations)
+
+
+def rollup_summary():
+    summary = {kind: [] for kind in ROLLUP_KINDS}
+    summary['total'] = {'count': 0, 'revenue': 0.0}
+    for doc in rollups_collection.find({}, {'_id': 0}).sort([('kind', ASCENDING), ('key', ASCENDING)]):
+        entry = {'key': doc['key'], 'count': doc['count'], 'revenue': round(doc.get('revenue', 0.0), 2)}
+        if doc['kind'] == 'total':
+            summary['total'] = {'count': entry['count'], 'revenue': entry['revenue']}
+        elif doc['kind'] in summary and doc['count'] > 0:
+            summary[doc['kind']].append(entry)
+    return summary
+
+
+@app.route('/admin/analytics')
+def admin_analytics():
+    if 'admin' not in session:
+        flash('You need to log in as admin!', 'danger')
+        return redirect(url_for('admin_login'))
+    return jsonify(rollup_summary())
+
+
+@app.cli.command('reconcile-rollups')
+def reconcile_rollups_command():
+    """Rebuild the appointment rollups from the appointments collection."""
+    click.echo(f'Reconciled {reconcile_rollups()} rollup counters.')
+
+
+# Streaming exports: rows go from a batched cursor straight into the
+# response, so memory stays flat however many documents are exported.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLLECTIONS = {
+    'appointments': (appointments_collection, ['_id', 'name', 'email', 'date', 'time', 'test',
+                                               'phone_number', 'description', 'created_at']),
+    'users': (users_collection, ['_id', 'name', 'email']),
+}
+
+
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    return value
+
+
+def export_rows(cursor, fields, fmt):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(fields)
+    for count, doc in enumerate(cursor, 1):
+        row = [export_value(doc.get(field)) for field in fields]
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, row)), default=str) + '\n')
+        # Hand a chunk to the server every batch instead of per row
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route('/admin/export/<collection>.<fmt>')
+def admin_export(collection, fmt):
+    # e.g. /admin/export/appointments.csv?date_from=2024-01-01&date_to=2024-01-31&test=Blood%20Tests&gzip=1
+    if 'admin' not in session:
+        flash('You need to log in as admin!', 'danger')
+        return redirect(url_for('admin_login'))
+    if collection not in EXPORT_COLLECTIONS or fmt not in ('csv', 'ndjson'):
+        abort(404)
+
+    source, fields = EXPORT_COLLECTIONS[collection]
+    query = {}
+    if collection == 'appointments':
+        date_range = {}
+        if request.args.get('date_from'):
+            date_range['$gte'] = request.args['date_from']
+        if request.args.get('date_to'):
+            date_range['$lte'] = request.args['date_to']
+        if date_range:
+            query['date'] = date_range
+        if request.args.get('test'):
+            query['test'] = request.args['test']
+
+    cursor = source.find(query, {field: 1 for field in fields}).batch_size(EXPORT_BATCH_SIZE)
+    body = export_rows(cursor, fields, fmt)
+    filename = f'{collection}.{fmt}'
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    # gzip=1 downloads a .gz file rather than using Content-Encoding, so
+    # clients save exactly what was compressed
+    if request.args.get('gzip') == '1':
+        body = gzip_stream(body)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    return app.response_class(body, mimetype=mimetype, headers=headers)
+
+
+# Bulk import: rows are validated like book_appointment's form, then
+# written with unordered bulk_write in batches of IMPORT_BATCH_SIZE.
+IMPORT_BATCH_SIZE = 1000
+IMPORT_REQUIRED_FIELDS = ('name', 'email', 'date', 'time', 'test', 'phone_number')
+
+
+def read_import_rows(stream, fmt):
+    # Yields (row number, dict or error message)
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(stream), 1):
+            yield number, row
+    else:
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, 'invalid JSON'
+                continue
+            yield number, row if isinstance(row, dict) else 'expected a JSON object'
+
+
+def validate_appointment(row):
+    # Same fields book_appointment stores; returns (document, error)
+    missing = [field for field in IMPORT_REQUIRED_FIELDS if not str(row.get(field) or '').strip()]
+    if missing:
+        return None, 'missing ' + ', '.join(missing)
+    doc = {field: str(row[field]).strip() for field in IMPORT_REQUIRED_FIELDS}
+    doc['description'] = str(row.get('description') or '')
+    try:
+        datetime.strptime(doc['date'], '%Y-%m-%d')
+        datetime.strptime(doc['time'], '%H:%M')
+        doc['created_at'] = datetime.fromisoformat(row['created_at']) if row.get('created_at') else datetime.now()
+    except (TypeError, ValueError):
+        return None, 'invalid date, time or created_at'
+    return doc, None
+
+
+def reserve_slot_places(test, date, time, wanted, capacity):
+    # As many of `wanted` places as the slot still has, set with a
+    # compare-and-swap on its count so concurrent bookings aren't overwritten
+    while True:
+        slot = slots_collection.find_one({'test': test, 'date': date, 'time': time})
+        booked = slot['booked'] if slot else 0
+        places = min(wanted, capacity - booked)
+        if places <= 0:
+            return 0
+        try:
+            result = slots_collection.update_one(
+                {'test': test, 'date': date, 'time': time, 'booked': booked},
+                {'$inc': {'booked': places}, '$set': {'capacity': capacity}},
+                upsert=slot is None
+            )
+        except DuplicateKeyError:
+            continue
+        if result.modified_count or result.upserted_id is not None:
+            return places
+
+
+def import_batch(batch, errors):
+    # Reserve every slot the batch needs in one bulk_write. Rows past a
+    # slot's capacity are rejected up front; a slot that no longer has room
+    # for all of the rest fails the conditional upsert on the unique slot
+    # index and then takes as many as still fit. The accepted rows are inserted.
+    groups = {}
+    for number, doc in batch:
+        groups.setdefault((doc['test'], doc['date'], slot_time(doc['time'])), []).append((number, doc))
+
+    slot_keys, slot_ops = [], []
+    for (test, date, time), rows in groups.items():
+        capacity = SLOT_CAPACITIES.get(test, DEFAULT_SLOT_CAPACITY)
+        errors.extend({'row': number, 'error': 'slot capacity exceeded'} for number, _ in rows[capacity:])
+        del rows[capacity:]
+        if not rows:
+            continue
+        slot_keys.append((test, date, time))
+        slot_ops.append(UpdateOne(
+            {'test': test, 'date': date, 'time': time, 'booked': {'$lte': capacity - len(rows)}},
+            {'$inc': {'booked': len(rows)}, '$set': {'capacity': capacity}},
+            upsert=True
+        ))
+
+    places = {key: len(groups[key]) for key in slot_keys}
+    if slot_ops:
+        try:
+            slots_collection.bulk_write(slot_ops, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                test, date, time = key = slot_keys[error['index']]
+                places[key] = reserve_slot_places(test, date, time, len(groups[key]),
+                                                  SLOT_CAPACITIES.get(test, DEFAULT_SLOT_CAPACITY))
+
+    accepted = []
+    for key in slot_keys:
+        rows = groups[key]
+        accepted.extend(rows[:places[key]])
+        errors.extend({'row': number, 'error': 'slot fully booked'} for number, _ in rows[places[key]:])
+    if not accepted:
+        return 0
+
+    # Rows the insert rejects give their slot back and stay out of the rollups
+    failed = {}
+    try:
+        appointments_collection.bulk_write([InsertOne(doc) for _, doc in accepted], ordered=False)
+    except BulkWriteError as e:
+        failed = {error['index']: error.get('errmsg', 'insert failed') for error in e.details['writeErrors']}
+    for index, message in failed.items():
+        number, doc = accepted[index]
+        errors.append({'row': number, 'error': message})
+        release_slot(doc['test'], doc['date'], doc['time'])
+    inserted = [doc for index, (_, doc) in enumerate(accepted) if index not in failed]
+    update_rollups(inserted, 1)
+    return len(inserted)
+
+
+def import_appointments(stream, fmt):
+    inserted = 0
+    errors = []
+    batch = []
+    for number, row in read_import_rows(stream, fmt):
+        doc, error = (None, row) if isinstance(row, str) else validate_appointment(row)
+        if error:
+            errors.append({'row': number, 'error': error})
+            continue
+        batch.append((number, doc))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            inserted += import_batch(batch, errors)
+            batch = []
+    if batch:
+        inserted += import_batch(batch, errors)
+    return {'inserted': inserted, 'rejected': len(errors), 'errors': sorted(errors, key=lambda e: e['row'])}
+
+
+def is_utf8(stream):
+    # Checked before importing anything, so a bad byte halfway through
+    # doesn't leave the batches before it imported; rewinds the stream
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in iter(lambda: stream.read(65536), b''):
+            decoder.decode(chunk)
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    finally:
+        stream.seek(0)
+    return True
+
+
+def import_format(filename, fmt=None):
+    fmt = fmt or os.path.splitext(filename or '')[1].lstrip('.').lower()
+    return fmt if fmt in ('csv', 'ndjson') else None
+
+
+@app.route('/admin/import', methods=['POST'])
+def admin_import():
+    if 'admin' not in session:
+        flash('You need to log in as admin!', 'danger')
+        return redirect(url_for('admin_login'))
+
+    upload = request.files.get('file')
+    fmt = import_format(upload.filename if upload else None, request.form.get('format'))
+    if not upload or not fmt:
+        return jsonify({'error': 'upload a .csv or .ndjson file'}), 400
+
+    if not is_utf8(upload.stream):
+        return jsonify({'error': 'the file is not UTF-8 text'}), 400
+
+    # utf-8-sig drops the byte order mark Excel puts in front of CSV headers
+    report = import_appointments(io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline=''), fmt)
+    return jsonify(report)
+
+
+@app.cli.command('import-appointments')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+def import_appointments_command(path, fmt):
+    """Bulk import appointments from a CSV or NDJSON file."""
+    fmt = import_format(path, fmt)
+    if not fmt:
+        raise click.UsageError('Use a .csv or .ndjson file, or pass --format.')
+    with open(path, 'rb') as f:
+        if not is_utf8(f):
+            raise click.ClickException(f'{path} is not UTF-8 text.')
+        report = import_appointments(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''), fmt)
+    for error in report['errors']:
+        click.echo(f"row {error['row']}: {error['error']}", err=True)
+    click.echo(f"Imported {report['inserted']} appointments, rejected {report['rejected']}.")
 
-    return render_template('admin_dashboard.html', users=users, appointments=appointments)
 
 @app.route('/admin/logout')
 def admin_logout():
@@ -503,16 +1396,115 @@ def delete_appointment(id):
         flash('You need to log in as admin!', 'danger')
         return redirect(url_for('admin_login'))
 
-    appointments_collection.delete_one({'_id': ObjectId(id)})
+    appointment = appointments_collection.find_one_and_delete({'_id': ObjectId(id)})
+    if appointment:
+        release_slot(appointment.get('test'), appointment.get('date'), appointment.get('time'))
+        update_rollups([appointment], -1)
     flash('Appointment deleted successfully.', 'success')
     return redirect(url_for('admin_dashboard'))
 
 @app.route("/chat")
+@page_cache.cached
 def chat():
   
     return render_template('chatbot.html') 
+
+
+# Chat API: each turn is one small Server-Sent Events response. The
+# conversation (the last CHAT_HISTORY symptom messages and the last disease
+# suggested) is kept server-side under an id in the session, in the
+# TTL-indexed chats collection so every worker sees it. Only with the
+# single-worker 'memory' session backend does it stay in process memory.
+# Answers are cached per normalised symptom text.
+CHAT_HISTORY = int(os.getenv("CHAT_HISTORY", 5))
+CHAT_MAX_MESSAGE = 500
+CHAT_PREVENTION_WORDS = {'prevent', 'prevention', 'avoid', 'protect', 'precautions'}
+CHAT_TEST_WORDS = {'test', 'tests', 'testing', 'diagnose', 'diagnosis', 'check'}
+CHAT_RESET_WORDS = {'reset', 'restart', 'clear'}
+
+if SESSION_BACKEND == 'memory':
+    chat_store = sessions.MemorySessionStore(max_entries=int(os.getenv("CHAT_MAX_SESSIONS", 10000)))
+else:
+    chat_store = sessions.MongoSessionStore(chats_collection)
+chat_answers = AnswerCache(max_entries=int(os.getenv("CHAT_CACHE_SIZE", 1024)))
+
+
+def load_conversation(chat_id):
+    loaded = chat_store.load(chat_id)
+    return json.loads(loaded[0]) if loaded else {'symptoms': [], 'disease': None}
+
+
+def symptom_answer(symptoms):
+    # (disease, [text chunks]) for the combined symptom text, from the cache
+    # when the same symptoms were asked about before
+    snapshot = knowledge.snapshot()
+    key = (snapshot, normalize_query(symptoms))
+    answer = chat_answers.get(key)
+    metrics.chat_answers.inc('cache' if answer else 'computed')
+    if answer:
+        return answer
+
+    candidates = rank_diseases(symptoms)
+    if not candidates:
+        return chat_answers.put(key, (None, (NO_DIAGNOSIS, 'Try describing your symptoms, e.g. "fever and cough".')))
+    disease = candidates[0][0]
+    chunks = [
+        f'Your symptoms most closely match {disease}.',
+        f'Prevention: {prevention_method(disease)}',
+        f'Recommended tests: {test_method(disease)}',
+    ]
+    if len(candidates) > 1:
+        chunks.append('Other possibilities: ' + ', '.join(name for name, score in candidates[1:]) + '.')
+    chunks.append('This is not a diagnosis, please consult a doctor.')
+    return chat_answers.put(key, (disease, tuple(chunks)))
+
+
+def chat_turn(conversation, message):
+    # Returns the text chunks to stream and updates the conversation
+    words = set(re.findall(r'[a-z]+', message.lower()))
+    if words & CHAT_RESET_WORDS:
+        conversation.update(symptoms=[], disease=None)
+        return ('Conversation cleared. What symptoms do you have?',)
+
+    follow_up = conversation['disease'] and not rank_diseases(message, 1)
+    if follow_up and words & CHAT_PREVENTION_WORDS:
+        return (f'To help prevent {conversation["disease"]}: {prevention_method(conversation["disease"])}',)
+    if follow_up and words & CHAT_TEST_WORDS:
+        return (f'Tests for {conversation["disease"]}: {test_method(conversation["disease"])}',)
+
+    conversation['symptoms'] = (conversation['symptoms'] + [message])[-CHAT_HISTORY:]
+    disease, chunks = symptom_answer(' '.join(conversation['symptoms']))
+    conversation['disease'] = disease
+    return chunks
+
+
+@app.route('/chat/stream', methods=['GET', 'POST'])
+def chat_stream():
+    # GET ?message=... (for EventSource) or POST a form/JSON "message"
+    payload = request.get_json(silent=True) if request.is_json else None
+    message = (payload or {}).get('message') if isinstance(payload, dict) else request.values.get('message')
+    if not isinstance(message, str) or not message.strip():
+        return jsonify({'error': 'message is required'}), 400
+    if len(message) > CHAT_MAX_MESSAGE:
+        return jsonify({'error': f'message is longer than {CHAT_MAX_MESSAGE} characters'}), 413
+
+    chat_id = session.get('chat_id')
+    if chat_id is None:
+        chat_id = session['chat_id'] = secrets.token_urlsafe(16)
+    conversation = load_conversation(chat_id)
+    chunks = chat_turn(conversation, message.strip())
+    chat_store.save(chat_id, json.dumps(conversation), int(SESSION_TTL.total_seconds()))
+
+    def stream():
+        for chunk in chunks:
+            yield sse_event({'text': chunk})
+        yield sse_event({'disease': conversation['disease']}, event='done')
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 # Contact Route
 @app.route('/contact')
+@page_cache.cached
 def contact():
     # Renders the contact form template
     return render_template('contact.html')
@@ -540,5 +1532,12 @@ def contact():
 
 
 
+@app.cli.command('init-db')
+def init_db_command():
+    """Connect to MongoDB and create the indexes."""
+    mongo.warm()
+    click.echo('Indexes are in place.')
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,247 @@
+"""ASGI serving mode: uvicorn asgi:application --workers 1
+
+Every route is the Flask app from app.py. The I/O-bound POST routes
+(/login, /register, /book_appointment) run natively on the event loop with
+pymongo's AsyncMongoClient, so a waiting MongoDB call doesn't pin a thread;
+bcrypt goes to the same process pool as in WSGI mode. Everything else is
+served through asgiref's WSGI adapter, which runs the Flask view in a thread.
+
+The async handlers run inside a normal Flask request context, so sessions,
+flash messages, url_for, before/after request hooks and /metrics behave
+exactly as in WSGI mode, and they share app.py's helpers for anything that
+isn't a database call. With SESSION_BACKEND=mongo the session is loaded and
+saved with the sync client, so those two calls run in a thread.
+"""
+import asyncio
+import io
+from datetime import datetime
+
+from asgiref.wsgi import WsgiToAsgi
+from bson.objectid import ObjectId
+from flask import flash, redirect, request, session, url_for
+from flask.ctx import RequestContext
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import app as web
+import metrics
+import sessions
+
+flask_app = web.app
+wsgi_fallback = WsgiToAsgi(flask_app)
+blocking_sessions = isinstance(getattr(flask_app.session_interface, 'store', None), sessions.MongoSessionStore)
+
+_async_db = None
+
+
+def async_db():
+    # Created on first use, inside the running event loop
+    global _async_db
+    if _async_db is None:
+        client = AsyncMongoClient(web.mongo_uri, event_listeners=[metrics.MongoCommandTimer()],
+                                  **web.mongo.options)
+        _async_db = client[web.mongo.db_name]
+    return _async_db
+
+
+async def await_hashing(future):
+    with metrics.timed('hashing'):
+        return await asyncio.wrap_future(future)
+
+
+async def login():
+    email = request.form['email']
+    password = request.form['password']
+    throttled = web.throttled_response('login', email)
+    if throttled:
+        return throttled
+    users = async_db()[web.users_collection.name]
+
+    user = await users.find_one({'email': email})
+    try:
+        valid = user is not None and await await_hashing(
+            web.password_hasher.check_future(user['password'], password))
+    except web.HashingBusy:
+        return web.busy_response()
+    if valid and web.password_hasher.needs_rehash(user['password']):
+        try:
+            new_hash = await await_hashing(web.password_hasher.hash_future(password))
+        except web.HashingBusy:
+            new_hash = None
+        if new_hash:
+            await users.update_one({'_id': user['_id']}, {'$set': {'password': new_hash}})
+    if valid:
+        web.rotate_session()
+        session['user'] = user['name']
+        return redirect(url_for('home2', message="success"))
+    return redirect(url_for('login', message="failure"))
+
+
+async def register():
+    try:
+        hashed_password = await await_hashing(web.password_hasher.hash_future(request.form['password']))
+    except web.HashingBusy:
+        return web.busy_response()
+    try:
+        await async_db()[web.users_collection.name].insert_one(
+            {'name': request.form['name'], 'email': request.form['email'], 'password': hashed_password})
+    except DuplicateKeyError:
+        flash('Email already registered. Try logging in!', 'warning')
+        return redirect(url_for('login'))
+    flash('Registration successful! Please login.', 'success')
+    return redirect(url_for('home2'))
+
+
+async def book_appointment():
+    if 'user' not in session:
+        flash('You need to log in first!', 'danger')
+        return redirect(url_for('thank_you'))
+
+    details = web.appointment_from_form(session['user'], request.form)
+    if not web.valid_slot(details['date'], details['time']):
+        return web.invalid_slot_response()
+    slots = async_db()[web.slots_collection.name]
+    query, update = web.slot_reservation(details['test'], details['date'], details['time'])
+    try:
+        slot = await slots.find_one_and_update(
+            query, update, upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        slot = None
+    if slot is None:
+        return web.slot_taken_response()
+
+    appointment = dict(details, created_at=datetime.now())
+    if web.booking_queue is not None and web.booking_queue.put(dict(appointment, _id=ObjectId())):
+        return web.appointment_booked_response(details)
+    try:
+        await async_db()[web.appointments_collection.name].insert_one(appointment)
+    except Exception:
+        await slots.update_one(*web.slot_release(details['test'], details['date'], details['time']))
+        raise
+    await async_db()[web.rollups_collection.name].bulk_write(web.rollup_operations([details], 1), ordered=False)
+    return web.appointment_booked_response(details)
+
+
+ASYNC_ROUTES = {
+    '/login': login,
+    '/register': register,
+    '/book_appointment': book_appointment,
+}
+
+
+async def read_body(receive):
+    body = io.BytesIO()
+    while True:
+        message = await receive()
+        body.write(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+    return body
+
+
+def build_environ(scope, body):
+    # Minimal WSGI environ for a Flask request context (PEP 3333 names)
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The whole body has been read, so a chunked request (no
+        # Content-Length) still has its form parsed
+        'wsgi.input_terminated': True,
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+            continue
+        key = 'HTTP_' + name
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def dispatch(handler, scope, receive, send):
+    environ = build_environ(scope, await read_body(receive))
+
+    ctx = flask_app.request_context(environ)
+    if blocking_sessions:
+        # Opened here, so pushing the context doesn't load it again
+        opened = await asyncio.to_thread(flask_app.session_interface.open_session, flask_app, ctx.request)
+        ctx = RequestContext(flask_app, environ, request=ctx.request, session=opened)
+    with ctx:
+        # Same error handling layers as Flask.wsgi_app / full_dispatch_request
+        try:
+            try:
+                response = flask_app.preprocess_request()
+                if response is None:
+                    response = await handler()
+            except Exception as e:
+                response = flask_app.handle_user_exception(e)
+            response = flask_app.make_response(response)
+            if blocking_sessions:
+                # to_thread carries the request context over
+                response = await asyncio.to_thread(flask_app.process_response, response)
+            else:
+                response = flask_app.process_response(response)
+        except Exception as e:
+            response = flask_app.make_response(flask_app.handle_exception(e))
+
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(key.lower().encode('latin1'), value.encode('latin1'))
+                    for key, value in response.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # The native handlers only use the async client, so connect the
+            # sync one here to create the indexes they rely on (unique emails,
+            # one document per slot), settle the bcrypt cost and re-queue
+            # spilled write-behind bookings; all block, so they run off the
+            # event loop
+            try:
+                await asyncio.to_thread(web.mongo.warm)
+                await asyncio.to_thread(lambda: web.password_hasher.rounds)
+                if web.booking_queue is not None:
+                    await asyncio.to_thread(web.booking_queue.start)
+            except Exception as error:
+                await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if web.booking_queue is not None:
+                await asyncio.to_thread(web.booking_queue.close)
+            if _async_db is not None:
+                await _async_db.client.close()
+            web.password_hasher.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    handler = ASYNC_ROUTES.get(scope.get('path')) if scope['type'] == 'http' else None
+    if handler and scope['method'] == 'POST':
+        await dispatch(handler, scope, receive, send)
+    else:
+        await wsgi_fallback(scope, receive, send)
@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+
+# Static asset pipeline. `flask build-assets` writes fingerprinted copies of
+# everything under static/ into static/build/ together with a manifest:
+#   - images are resized to a few widths and also saved as WebP
+#   - CSS and JS get .gz (and .br when the brotli package is installed) twins
+# The app reads the manifest to rewrite url_for('static', ...) to the hashed
+# files, which can then be cached as immutable.
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST_PATH = os.path.join(BUILD_DIR, 'manifest.json')
+
+IMAGE_WIDTHS = (480, 960, 1600)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+TEXT_EXTENSIONS = ('.css', '.js')
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+CSS_URL = re.compile(r"url\((['\"]?)([^'\")]+)\1\)")
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:10]
+
+
+def hashed_name(name, digest, suffix=''):
+    base, ext = os.path.splitext(name)
+    return f'{base}.{digest}{suffix}{ext}'
+
+
+def write_file(relative_path, data):
+    path = os.path.join(BUILD_DIR, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def encode_image(image, ext, quality):
+    from io import BytesIO
+    buffer = BytesIO()
+    if ext == '.webp':
+        image.save(buffer, 'WEBP', quality=quality, method=6)
+    elif ext == '.png':
+        image.save(buffer, 'PNG', optimize=True)
+    else:
+        image.convert('RGB').save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def build_image(name, data):
+    from io import BytesIO
+    from PIL import Image
+
+    digest = content_hash(data)
+    source = Image.open(BytesIO(data))
+    source.load()
+    ext = os.path.splitext(name)[1].lower()
+
+    # Only widths smaller than the original, plus the original capped at the largest width
+    widths = [w for w in IMAGE_WIDTHS if w < source.width] or [source.width]
+    if source.width <= IMAGE_WIDTHS[-1] and source.width not in widths:
+        widths.append(source.width)
+
+    variants = {}
+    for width in widths:
+        image = source
+        if width != source.width:
+            height = round(source.height * width / source.width)
+            image = source.resize((width, height), Image.LANCZOS)
+        path = hashed_name(name, digest, f'.{width}w')
+        webp = os.path.splitext(path)[0] + '.webp'
+        write_file(path, encode_image(image, ext, JPEG_QUALITY))
+        write_file(webp, encode_image(image, '.webp', WEBP_QUALITY))
+        variants[str(width)] = {'path': path, 'webp': webp}
+
+    largest = variants[str(max(widths))]
+    return {'path': largest['path'], 'webp': largest['webp'], 'variants': variants}
+
+
+def rewrite_css_urls(name, text, manifest):
+    # Point url(...) references at the fingerprinted images. Paths are
+    # relative to the stylesheet, and build/ mirrors static/, so only the
+    # file name changes.
+    def replace(match):
+        quote, target = match.groups()
+        if ':' in target or target.startswith('/'):
+            return match.group(0)
+        resolved = os.path.normpath(os.path.join(os.path.dirname(name), target)).replace(os.sep, '/')
+        entry = manifest.get(resolved)
+        if not entry:
+            return match.group(0)
+        relative = os.path.relpath(entry['path'], os.path.dirname(name)).replace(os.sep, '/')
+        return f'url({quote}{relative}{quote})'
+    return CSS_URL.sub(replace, text)
+
+
+def build_text(name, data, manifest):
+    if name.endswith('.css'):
+        data = rewrite_css_urls(name, data.decode('utf-8'), manifest).encode('utf-8')
+    path = hashed_name(name, content_hash(data))
+    write_file(path, data)
+    encodings = []
+    try:
+        import brotli
+        write_file(path + '.br', brotli.compress(data, quality=11))
+        encodings.append('br')
+    except ImportError:
+        pass
+    write_file(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+    encodings.append('gzip')
+    return {'path': path, 'encodings': encodings}
+
+
+def source_files(extensions):
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if os.path.abspath(root).startswith(BUILD_DIR):
+            continue
+        for filename in sorted(files):
+            if filename.lower().endswith(extensions):
+                full = os.path.join(root, filename)
+                yield os.path.relpath(full, STATIC_DIR).replace(os.sep, '/'), full
+
+
+def build_assets():
+    manifest = {}
+    # Images first so stylesheets can reference their hashed names
+    for name, full in source_files(IMAGE_EXTENSIONS):
+        with open(full, 'rb') as f:
+            manifest[name] = build_image(name, f.read())
+    for name, full in source_files(TEXT_EXTENSIONS):
+        with open(full, 'rb') as f:
+            manifest[name] = build_text(name, f.read(), manifest)
+
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest():
+    # No build yet means plain static files, so development needs no extra step
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
@@ -0,0 +1,280 @@
+"""Offline load test and micro-benchmarks for the app.
+
+Runs every route against mongomock (or a local mongod with --mongo-uri),
+seeded with a reproducible data set, and writes the results as JSON so two
+runs can be compared. On a real mongod the benchmark gets its own database
+(--mongo-db, flask_auth_bench by default), which it drops and reseeds; one
+that already holds data is only dropped with --drop.
+
+    python bench.py --requests 200 --concurrency 8 --output before.json
+    python bench.py --requests 200 --concurrency 8 --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+
+def allow_bulk_sort(mongomock):
+    # Recent pymongo passes sort= when an UpdateOne/ReplaceOne joins a
+    # bulk_write; mongomock's builder doesn't know the argument (and the
+    # app never sets it), so drop it instead of failing the rollup updates
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ('add_update', 'add_replace'):
+        def accept(original):
+            def method(self, *args, sort=None, **kwargs):
+                return original(self, *args, **kwargs)
+            return method
+        setattr(builder, name, accept(getattr(builder, name)))
+
+
+def load_app(mongo_uri, mongo_db, bcrypt_rounds):
+    # Configure before app.py reads the environment
+    os.environ['MONGO_URI'] = mongo_uri or 'mongodb://localhost:27017'
+    os.environ['MONGO_DB'] = mongo_db
+    os.environ['BCRYPT_LOG_ROUNDS'] = str(bcrypt_rounds)
+    os.environ.setdefault('SLOT_CAPACITY', '1000000')
+    # Every benchmark request comes from one address; measure the login
+    # path itself rather than the throttle's 429s
+    os.environ.setdefault('THROTTLE_IP_BURST', '1000000000')
+    os.environ.setdefault('THROTTLE_ACCOUNT_BURST', '1000000000')
+    if not mongo_uri:
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+        allow_bulk_sort(mongomock)
+    import app
+    app.app.config['TESTING'] = True
+    return app
+
+
+def reset_database(app, drop):
+    # Every collection the app uses (users, appointments, slots, rollups,
+    # settings, sessions, chats) goes with the database, then the indexes
+    # are put back
+    db = app.mongo.db
+    if not drop and any(db[name].estimated_document_count() for name in db.list_collection_names()):
+        raise SystemExit(f'Database {app.mongo.db_name} already has data; pass --drop to reset it '
+                         f'or --mongo-db to pick another one.')
+    app.mongo.client.drop_database(app.mongo.db_name)
+    app.ensure_indexes()
+
+
+def seed(app, users, appointments, rng):
+    password = app.password_hasher.hash('password')
+    app.users_collection.insert_many([
+        {'name': f'user{i}', 'email': f'user{i}@example.com', 'password': password}
+        for i in range(users)
+    ])
+    tests = list(app.knowledge.current.tests)
+    start = datetime(2024, 1, 1)
+    app.appointments_collection.insert_many([
+        {
+            'name': f'user{i % max(users, 1)}',
+            'email': f'user{i % max(users, 1)}@example.com',
+            'date': (start + timedelta(days=rng.randrange(365))).strftime('%Y-%m-%d'),
+            'time': f'{rng.randrange(8, 18):02d}:{rng.choice(("00", "30"))}',
+            'test': rng.choice(tests),
+            'phone_number': str(rng.randrange(10 ** 9, 10 ** 10)),
+            'description': 'seeded',
+            'created_at': start + timedelta(minutes=i),
+        }
+        for i in range(appointments)
+    ])
+
+
+def scenarios(app, users, rng):
+    symptoms = list(app.knowledge.current.symptom_search.phrases) + ['no matching symptoms at all']
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def unique():
+        with lock:
+            return next(counter)
+
+    def login(client):
+        n = rng.randrange(max(users, 1))
+        return client.post('/login', data={'email': f'user{n}@example.com', 'password': 'password'})
+
+    def register(client):
+        n = unique()
+        return client.post('/register', data={'name': f'bench{n}', 'email': f'bench{n}@example.com',
+                                              'password': 'password'})
+
+    def book(client):
+        with client.session_transaction() as session:
+            session['user'] = 'bench'
+        n = unique()
+        return client.post('/book_appointment', data={
+            'email': f'bench{n}@example.com', 'date': f'2025-{n % 12 + 1:02d}-{n % 28 + 1:02d}',
+            'time': f'{n % 10 + 8:02d}:00', 'test': rng.choice(app.knowledge.current.test_list),
+            'phone_number': '5550100', 'description': 'bench',
+        })
+
+    def symptom(client):
+        return client.post('/symptoms', data={'symptoms': rng.choice(symptoms)})
+
+    def quiz(client):
+        return client.post('/quiz', data={q['id']: rng.choice(('Yes', 'No')) for q in app.knowledge.current.quiz_data})
+
+    def test_details(client):
+        return client.get(f'/get_test_details/{rng.choice(app.knowledge.current.test_list)}')
+
+    def admin_dashboard(client):
+        with client.session_transaction() as session:
+            session['admin'] = True
+        return client.get('/admin/dashboard')
+
+    return {
+        '/login': login,
+        '/register': register,
+        '/book_appointment': book,
+        '/symptoms': symptom,
+        '/quiz': quiz,
+        '/get_test_details/<name>': test_details,
+        '/admin/dashboard': admin_dashboard,
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_route(app, action, requests, concurrency):
+    local = threading.local()
+
+    def one(_):
+        # The test client keeps cookies, so each thread needs its own
+        if not hasattr(local, 'client'):
+            local.client = app.app.test_client()
+        started = time.perf_counter()
+        response = action(local.client)
+        return time.perf_counter() - started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': requests,
+        'rps': round(requests / wall, 1) if wall else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+        'statuses': statuses,
+    }
+
+
+def micro_benchmarks(app, number):
+    answers = {q['id']: 'Yes' for q in app.knowledge.current.quiz_data}
+    symptoms = list(app.knowledge.current.symptom_search.phrases)
+    cases = {
+        'predict_disease': lambda: app.predict_disease('i have fever chills headache and nausea'),
+        'predict_disease_miss': lambda: app.predict_disease('nothing that matches anything'),
+        'rank_diseases_batch_22': lambda: app.rank_diseases_batch(symptoms),
+        'prevention_method': lambda: app.prevention_method('Malaria'),
+        'test_method': lambda: app.test_method('Malaria'),
+        'recommend_tests': lambda: app.recommend_tests(answers),
+        'login_throttle': lambda: app.login_throttle.take([('bench:ip', app.THROTTLE_IP_LIMIT),
+                                                           ('bench:account', app.THROTTLE_ACCOUNT_LIMIT)]),
+    }
+    results = {}
+    for name, fn in cases.items():
+        best = min(timeit.repeat(fn, number=number, repeat=5))
+        results[name] = {'us_per_call': round(best / number * 1e6, 3)}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f'\nCompared with {baseline_path}:')
+    for route, result in current['routes'].items():
+        before = baseline.get('routes', {}).get(route)
+        if before and before.get('p95_ms'):
+            change = (result['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+            print(f'  {route:28} p95 {before["p95_ms"]:>9.2f} -> {result["p95_ms"]:>9.2f} ms ({change:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--users', type=int, default=1000, help='seeded users')
+    parser.add_argument('--appointments', type=int, default=10000, help='seeded appointments')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--routes', nargs='*', help='only run these routes')
+    parser.add_argument('--micro-number', type=int, default=2000, help='calls per micro-benchmark repeat')
+    parser.add_argument('--bcrypt-rounds', type=int, default=4,
+                        help='bcrypt cost for seeded and new passwords (4 keeps hashing out of the way)')
+    parser.add_argument('--mongo-uri', help='use a real (local) mongod instead of mongomock')
+    parser.add_argument('--mongo-db', default='flask_auth_bench', help='database to drop and seed')
+    parser.add_argument('--drop', action='store_true', help='reset --mongo-db even if it already has data')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare p95 latency against')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    app = load_app(args.mongo_uri, args.mongo_db, args.bcrypt_rounds)
+    if args.mongo_uri:
+        reset_database(app, args.drop)
+    seed(app, args.users, args.appointments, rng)
+
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'backend': 'mongod' if args.mongo_uri else 'mongomock',
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'routes': {},
+        'micro': {},
+    }
+    try:
+        for route, action in scenarios(app, args.users, rng).items():
+            if args.routes and route not in args.routes:
+                continue
+            result = run_route(app, action, args.requests, args.concurrency)
+            results['routes'][route] = result
+            print(f'{route:28} {result["rps"]:>9} req/s  p50 {result["p50_ms"]:>8.2f}  '
+                  f'p95 {result["p95_ms"]:>8.2f}  p99 {result["p99_ms"]:>8.2f} ms  {result["statuses"]}')
+
+        results['micro'] = micro_benchmarks(app, args.micro_number)
+        for name, result in results['micro'].items():
+            print(f'{name:28} {result["us_per_call"]:>9.3f} us/call')
+    finally:
+        app.password_hasher.shutdown()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nWrote {args.output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
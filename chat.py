@@ -0,0 +1,48 @@
+import json
+import threading
+from collections import OrderedDict
+
+from symptom_search import tokenize
+
+# Pieces of the chat endpoint that don't depend on the app: the answer
+# cache and the Server-Sent Events framing. Answers are cached under a
+# normalised form of the symptoms (stemmed, stopwords dropped, sorted), so
+# "chest pain and short of breath" and "Short of breath, chest pain!" are
+# one entry.
+
+
+def normalize_query(text):
+    return ' '.join(sorted(set(tokenize(text))))
+
+
+class AnswerCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, answer):
+        with self.lock:
+            self.entries[key] = answer
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return answer
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def sse_event(data, event=None):
+    # One Server-Sent Events message; data is sent as a single JSON line
+    lines = [f'event: {event}'] if event else []
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
@@ -0,0 +1,29 @@
+# gunicorn -c gunicorn.conf.py app:app
+import os
+
+preload_app = True
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+
+
+def post_fork(server, worker):
+    # Each worker opens its own MongoDB client (the preloaded master never
+    # connects) and warms it before taking requests, then starts its
+    # write-behind flusher, which re-queues bookings spilled by a worker
+    # that has exited. An error here would stop gunicorn altogether, so a
+    # database that can't be reached is only logged: the client connects
+    # (and creates the indexes) on first use instead, and the pages that
+    # don't need MongoDB keep working meanwhile.
+    from app import booking_queue, mongo
+    try:
+        mongo.warm()
+    except Exception as error:
+        server.log.warning('Worker %s could not connect to MongoDB yet: %s', worker.pid, error)
+    if booking_queue is not None:
+        booking_queue.start()
+
+
+def worker_exit(server, worker):
+    # Write out (or spill) queued write-behind bookings before the worker goes
+    from app import booking_queue
+    if booking_queue is not None:
+        booking_queue.close()
@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# The medical knowledge base (diseases, test catalogue, quiz) lives in JSON
+# files under data/, each with a "version". They are loaded into one
+# immutable snapshot that every route reads; a reload builds a complete new
+# snapshot off to the side and publishes it with a single assignment, so
+# readers never take a lock and never see half of an update. The files are
+# re-checked at most once per check_interval, which is how every worker picks
+# up an edit without a restart. A file that fails to load or build leaves the
+# previous snapshot in place.
+
+logger = logging.getLogger(__name__)
+
+
+class KnowledgeBase:
+    def __init__(self, data_dir, build, check_interval=2.0, on_reload=()):
+        self.data_dir = data_dir
+        self.build = build
+        self.check_interval = check_interval
+        self.on_reload = list(on_reload)
+        self.checked_at = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self.fingerprint = self.files_fingerprint()
+        self.current = self.build(self.read())
+
+    def files(self):
+        return sorted(name for name in os.listdir(self.data_dir) if name.endswith('.json'))
+
+    def files_fingerprint(self):
+        fingerprint = []
+        for name in self.files():
+            stat = os.stat(os.path.join(self.data_dir, name))
+            fingerprint.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(fingerprint)
+
+    def read(self):
+        # {"diseases": {...}, "quiz": {...}, ...} keyed by file name
+        data = {}
+        for name in self.files():
+            with open(os.path.join(self.data_dir, name), encoding='utf-8') as f:
+                data[name[:-len('.json')]] = json.load(f)
+        return data
+
+    def snapshot(self):
+        # The read path: one clock read, plus a stat of the data files at most
+        # once per check_interval
+        now = time.monotonic()
+        if now - self.checked_at >= self.check_interval:
+            self.checked_at = now
+            if self.files_fingerprint() != self.fingerprint:
+                self.reload()
+        return self.current
+
+    def reload(self, force=False):
+        # Only one thread rebuilds; the others keep serving the old snapshot
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            fingerprint = self.files_fingerprint()
+            if fingerprint == self.fingerprint and not force:
+                return False
+            try:
+                snapshot = self.build(self.read())
+            except (OSError, ValueError, KeyError, TypeError) as error:
+                logger.error('Keeping knowledge base %s, reload failed: %s', self.current.versions, error)
+                self.fingerprint = fingerprint
+                return False
+            self.current = snapshot
+            self.fingerprint = fingerprint
+        finally:
+            self._reload_lock.release()
+        logger.info('Loaded knowledge base %s', snapshot.versions)
+        for callback in self.on_reload:
+            callback(snapshot)
+        return True
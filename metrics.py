@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from pymongo import monitoring
+
+# In-process metrics in the Prometheus text format. Every request gets a
+# latency observation per endpoint/method/status, plus the time it spent in
+# MongoDB, password hashing and template rendering. Counters are per worker
+# process; Prometheus sums them across workers when scraping each one.
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PHASES = ('db', 'hashing', 'render')
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_values, (buckets, total, count) in sorted(self.series.items()):
+                labels = format_labels(self.labels, label_values)
+                for bound, bucket_count in zip(BUCKETS, buckets):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{labels}}} {total}')
+                lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values):
+        with self.lock:
+            self.series[label_values] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in sorted(self.series.items()):
+                lines.append(f'{self.name}{{{format_labels(self.labels, label_values)}}} {value}')
+        return lines
+
+
+class Gauge:
+    # Values are read from collect() at scrape time
+    def __init__(self, name, help_text, labels, collect):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} gauge']
+        for label_values, value in sorted(self.collect().items()):
+            labels = f'{{{format_labels(self.labels, label_values)}}}' if self.labels else ''
+            lines.append(f'{self.name}{labels} {value}')
+        return lines
+
+
+def format_labels(names, values):
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for value in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Request latency.',
+                             ('endpoint', 'method', 'status'))
+phase_duration = Histogram('http_request_phase_seconds', 'Time spent per request in db, hashing or render.',
+                           ('endpoint', 'phase'))
+mongo_duration = Histogram('mongodb_command_duration_seconds', 'MongoDB command latency.',
+                           ('command', 'outcome'))
+login_throttle = Counter('login_throttle_total', 'Login attempts let through or rejected by the throttle.',
+                         ('endpoint', 'outcome'))
+chat_answers = Counter('chat_answers_total', 'Chat answers served from the answer cache or computed.',
+                       ('source',))
+registry = [request_duration, phase_duration, mongo_duration, login_throttle, chat_answers]
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def add_phase(phase, seconds):
+    if has_request_context() and 'phase_timings' in g:
+        g.phase_timings[phase] += seconds
+
+
+@contextmanager
+def timed(phase):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, time.perf_counter() - started)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    # pymongo calls these on the thread that ran the command, so request
+    # context is available to attribute the time to the current request.
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event, 'success')
+
+    def failed(self, event):
+        self.record(event, 'failure')
+
+    def record(self, event, outcome):
+        seconds = event.duration_micros / 1e6
+        mongo_duration.observe(seconds, event.command_name, outcome)
+        add_phase('db', seconds)
+
+
+def init_app(app, slow_request_ms=None):
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.phase_timings = defaultdict(float)
+
+    def render_started(sender, **extra):
+        g.render_started = time.perf_counter()
+
+    def render_finished(sender, **extra):
+        if 'render_started' in g:
+            add_phase('render', time.perf_counter() - g.pop('render_started'))
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    @app.after_request
+    def record_request(response):
+        if 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unmatched'
+        request_duration.observe(elapsed, endpoint, request.method, response.status_code)
+        for phase in PHASES:
+            phase_duration.observe(g.phase_timings.get(phase, 0.0), endpoint, phase)
+
+        if slow_request_ms and elapsed * 1000 >= slow_request_ms:
+            app.logger.warning('slow request %s', json.dumps({
+                'endpoint': endpoint,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'total_ms': round(elapsed * 1000, 1),
+                **{f'{phase}_ms': round(g.phase_timings.get(phase, 0.0) * 1000, 1) for phase in PHASES},
+            }))
+        return response
@@ -0,0 +1,150 @@
+import os
+import threading
+
+from pymongo import MongoClient, monitoring
+
+# One MongoClient per process, created on first use. Importing the app
+# doesn't connect, and a worker forked from a preloaded master builds its
+# own client instead of reusing sockets inherited from the parent.
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    # Live connection counts for this process, read by /metrics
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = 0
+        self.in_use = 0
+        self.checkout_failures = 0
+
+    def reset(self):
+        with self.lock:
+            self.open = self.in_use = self.checkout_failures = 0
+
+    def _add(self, field, amount):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def connection_created(self, event):
+        self._add('open', 1)
+
+    def connection_closed(self, event):
+        self._add('open', -1)
+
+    def connection_checked_out(self, event):
+        self._add('in_use', 1)
+
+    def connection_checked_in(self, event):
+        self._add('in_use', -1)
+
+    def connection_check_out_failed(self, event):
+        self._add('checkout_failures', 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+class MongoConnection:
+    def __init__(self, uri, db_name, options=None, event_listeners=(), on_connect=None):
+        self.uri = uri
+        self.db_name = db_name
+        self.options = options or {}
+        self.pool_monitor = PoolMonitor()
+        self.event_listeners = list(event_listeners) + [self.pool_monitor]
+        self.on_connect = on_connect
+        self._client = None
+        self._pid = None
+        self._connecting = None
+        self._lock = threading.RLock()
+
+    @property
+    def client(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._connecting is not None:
+                    # on_connect (running in this thread, the lock is reentrant)
+                    # uses the client that is still being set up
+                    return self._connecting
+                if self._client is None or self._pid != os.getpid():
+                    # A client inherited through fork is dropped, not closed:
+                    # its sockets still belong to the parent process.
+                    self.pool_monitor.reset()
+                    client = MongoClient(self.uri, connect=False, event_listeners=self.event_listeners,
+                                         **self.options)
+                    # Only a successful on_connect marks the process as
+                    # connected; after a failure the next use tries again
+                    self._connecting = client
+                    try:
+                        if self.on_connect:
+                            self.on_connect()
+                    except Exception:
+                        client.close()
+                        raise
+                    finally:
+                        self._connecting = None
+                    self._client, self._pid = client, os.getpid()
+        return self._client
+
+    @property
+    def db(self):
+        return self.client[self.db_name]
+
+    def collection(self, name):
+        return LazyCollection(self, name)
+
+    def warm(self):
+        # Connect now instead of on the first request; pymongo's background
+        # task then fills the pool up to minPoolSize
+        self.client.admin.command('ping')
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+
+
+class LazyCollection:
+    # Stands in for a pymongo Collection and resolves it on every use, so
+    # module-level names like users_collection stay valid across forks.
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self.connection.db[self.name], attr)
+
+
+def client_options_from_env():
+    # Only the options that are set, so pymongo's defaults apply otherwise
+    names = {
+        'MONGO_MAX_POOL_SIZE': ('maxPoolSize', int),
+        'MONGO_MIN_POOL_SIZE': ('minPoolSize', int),
+        'MONGO_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int),
+        'MONGO_CONNECT_TIMEOUT_MS': ('connectTimeoutMS', int),
+        'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int),
+        'MONGO_SOCKET_TIMEOUT_MS': ('socketTimeoutMS', int),
+        'MONGO_READ_PREFERENCE': ('readPreference', str),
+        'MONGO_WRITE_CONCERN': ('w', lambda value: int(value) if value.isdigit() else value),
+        'MONGO_JOURNAL': ('journal', lambda value: value.lower() in ('1', 'true', 'yes')),
+    }
+    options = {}
+    for env, (option, convert) in names.items():
+        value = os.getenv(env)
+        if value:
+            options[option] = convert(value)
+    return options
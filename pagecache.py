@@ -0,0 +1,81 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+
+# Cache for pages whose HTML doesn't depend on the user: the rendered bytes
+# are kept in a bounded LRU keyed on the URL, served with a strong ETag, and
+# If-None-Match gets a 304. Requests with pending flash messages are always
+# rendered so the messages are consumed as usual. Any change to a file in
+# the templates folder drops every cached page.
+
+
+class PageCache:
+    def __init__(self, template_dir, max_entries=256, check_interval=1.0):
+        self.template_dir = template_dir
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = None
+        self.checked_at = 0.0
+
+    def template_generation(self):
+        # Newest template mtime, looked up at most once per check_interval
+        now = time.monotonic()
+        if now - self.checked_at >= self.check_interval:
+            newest = 0.0
+            for root, dirs, files in os.walk(self.template_dir):
+                for filename in files:
+                    newest = max(newest, os.stat(os.path.join(root, filename)).st_mtime)
+            self.checked_at = now
+            if newest != self.generation:
+                with self.lock:
+                    self.entries.clear()
+                self.generation = newest
+        return self.generation
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get(self, key):
+        self.template_generation()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, mimetype):
+        entry = (body, hashlib.sha256(body).hexdigest(), mimetype)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if '_flashes' in session:
+                return view(*args, **kwargs)
+
+            key = (request.endpoint, request.full_path)
+            entry = self.get(key)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = self.put(key, response.get_data(), response.mimetype)
+
+            body, etag, mimetype = entry
+            response = current_app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response.make_conditional(request)
+        return wrapper
@@ -0,0 +1,123 @@
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+# bcrypt runs in its own processes so a burst of logins can't tie up the
+# request threads. This module only imports bcrypt, which keeps the
+# spawned workers small and independent of the Flask app.
+
+MIN_ROUNDS = 10
+MAX_ROUNDS = 15
+
+
+class HashingBusy(Exception):
+    # Raised when the pool already has as much work queued as it accepts
+    pass
+
+
+def hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def check_password(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+def hash_rounds(hashed):
+    # "$2b$12$..." -> 12
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def calibrate_rounds(target_ms):
+    # Time one hash at the minimum cost, then go up one round (double the
+    # work) for as long as we stay inside the latency budget.
+    started = time.perf_counter()
+    hash_password('calibration', MIN_ROUNDS)
+    elapsed_ms = max((time.perf_counter() - started) * 1000, 0.001)
+    extra = int(math.floor(math.log2(max(target_ms / elapsed_ms, 1))))
+    return min(MIN_ROUNDS + extra, MAX_ROUNDS)
+
+
+class PasswordHasher:
+    # Without a fixed cost, shared_rounds(calibrate) is asked for it on first
+    # use: it should return the cost already agreed by other processes, or
+    # store calibrate()'s result as that cost. Otherwise every worker (and
+    # every restart) would time its own hash and pick a slightly different cost.
+    def __init__(self, workers=None, queue_depth=None, rounds=None, target_ms=250, shared_rounds=None):
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        self.queue_depth = queue_depth if queue_depth is not None else self.workers * 4
+        self.target_ms = target_ms
+        self.shared_rounds = shared_rounds
+        self._rounds = rounds
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_depth)
+        self._pool = None
+        self._lock = threading.Lock()
+        self._rounds_lock = threading.Lock()
+
+    @property
+    def rounds(self):
+        if self._rounds is None:
+            with self._rounds_lock:
+                if self._rounds is None:
+                    def calibrate():
+                        return calibrate_rounds(self.target_ms)
+                    self._rounds = self.shared_rounds(calibrate) if self.shared_rounds else calibrate()
+        return self._rounds
+
+    def _executor(self):
+        # Created on first use so importing the app never starts processes
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._pool
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    # The *_future variants return a concurrent.futures.Future so async
+    # callers can await it (asyncio.wrap_future) instead of blocking.
+    def hash_future(self, password):
+        return self._submit(hash_password, password, self.rounds)
+
+    def check_future(self, hashed, password):
+        return self._submit(check_password, hashed, password)
+
+    def hash(self, password):
+        return self.hash_future(password).result()
+
+    def check(self, hashed, password):
+        return self.check_future(hashed, password).result()
+
+    def needs_rehash(self, hashed):
+        # Only upgrade: a hash stronger than our cost is left alone
+        rounds = hash_rounds(hashed)
+        return rounds is not None and rounds < self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
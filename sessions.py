@@ -0,0 +1,135 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# Server-side sessions: the cookie only carries a random session id and the
+# data lives in a store, so requests don't carry (and re-verify) a signed
+# copy of everything the app put in the session.
+#   MemorySessionStore - per-process LRU with TTL, for a single worker
+#   MongoSessionStore  - TTL-indexed collection, shared by all workers
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, fresh_until=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Past this point the stored expiry is refreshed even without changes
+        self.fresh_until = fresh_until
+        # Set by rotate(); its stored entry is deleted when the session is saved
+        self.replaced_sid = None
+
+    def rotate(self):
+        # Same data under a new id, so an id planted in the browser before
+        # a login is worthless after it
+        if self.replaced_sid is None and not self.new:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class MemorySessionStore:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, sid):
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None:
+                return None
+            data, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[sid]
+                return None
+            self.entries.move_to_end(sid)
+            return data, expires_at
+
+    def save(self, sid, data, ttl):
+        with self.lock:
+            self.entries[sid] = (data, time.time() + ttl)
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+
+class MongoSessionStore:
+    # The collection needs a TTL index on expires_at (see ensure_indexes)
+    def __init__(self, collection):
+        self.collection = collection
+
+    def load(self, sid):
+        doc = self.collection.find_one({'_id': sid})
+        if doc is None:
+            return None
+        expires_at = doc['expires_at'].replace(tzinfo=timezone.utc).timestamp()
+        # The TTL monitor only runs once a minute
+        if expires_at <= time.time():
+            return None
+        return doc['data'], expires_at
+
+    def save(self, sid, data, ttl):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        self.collection.replace_one({'_id': sid}, {'data': data, 'expires_at': expires_at}, upsert=True)
+
+    def delete(self, sid):
+        self.collection.delete_one({'_id': sid})
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store, ttl=timedelta(days=1)):
+        self.store = store
+        self.ttl = int(ttl.total_seconds())
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        loaded = self.store.load(sid) if sid else None
+        if loaded is None:
+            return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+        data, expires_at = loaded
+        return ServerSideSession(serializer.loads(data), sid=sid, fresh_until=expires_at - self.ttl / 2)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced_sid is not None:
+            self.store.delete(session.replaced_sid)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Write only when something changed or half the TTL has passed
+        stale = session.fresh_until is not None and time.time() > session.fresh_until
+        if not (session.modified or session.new or stale):
+            return
+        self.store.save(session.sid, serializer.dumps(dict(session)), self.ttl)
+        response.vary.add('Cookie')
+        response.set_cookie(
+            name, session.sid,
+            max_age=self.ttl,
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            httponly=self.get_cookie_httponly(app),
+            samesite=self.get_cookie_samesite(app),
+        )
@@ -0,0 +1,121 @@
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# BM25 retrieval over the symptom phrases. Every phrase is a row of a dense
+# weight matrix built once; a query becomes a term vector and is scored
+# against all phrases with one matrix-vector product (a batch of queries
+# with one matrix-matrix product). Tokens are lower-cased, lightly stemmed
+# and, when they aren't in the vocabulary, corrected to the closest known
+# term, so "short of breath and chest pian" still finds the heart attack
+# phrase. A phrase only counts once the query covers min_share of its
+# weight, so one shared word ("pain") doesn't make a diagnosis.
+
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'am', 'are', 'as', 'at', 'be', 'been', 'but', 'by', 'feel', 'feeling', 'for',
+    'from', 'got', 'has', 'have', 'having', 'i', 'im', 'in', 'is', 'it', 'its', 'me', 'my', 'of',
+    'on', 'or', 'some', 'the', 'to', 'very', 'with', 'also', 'lot', 'lots', 'bit', 'since', 'days',
+))
+SUFFIXES = (('ness', 4), ('ing', 4), ('s', 4))
+TOKEN = re.compile(r'[a-z]+')
+
+
+def stem(word):
+    # Just enough to line up "headaches"/"headache", "breathing"/"breath",
+    # "shortness"/"short"; a stem keeps at least the given number of letters
+    for suffix, keep in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= keep and not word.endswith('ss'):
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text):
+    return [stem(word) for word in TOKEN.findall(text.lower()) if word not in STOPWORDS]
+
+
+def edit_distance(a, b, limit):
+    # Damerau-Levenshtein (adjacent transpositions), giving up past limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2, previous = None, list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, char_b in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+class SymptomSearch:
+    def __init__(self, patterns, k1=1.2, b=0.75, min_share=0.4):
+        self.diseases = list(dict.fromkeys(patterns.values()))
+        disease_index = {disease: i for i, disease in enumerate(self.diseases)}
+        # Rows are grouped by disease so each disease's best phrase is one
+        # maximum.reduceat over its run of rows
+        self.phrases = sorted(patterns, key=lambda phrase: disease_index[patterns[phrase]])
+        owners = [disease_index[patterns[phrase]] for phrase in self.phrases]
+        self.starts = np.searchsorted(owners, np.arange(len(self.diseases)))
+
+        documents = [tokenize(phrase) for phrase in self.phrases]
+        self.vocabulary = {term: i for i, term in enumerate(sorted({t for doc in documents for t in doc}))}
+
+        counts = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(documents):
+            for term in doc:
+                counts[row, self.vocabulary[term]] += 1
+        lengths = counts.sum(axis=1, keepdims=True)
+        document_frequency = (counts > 0).sum(axis=0)
+        idf = np.log(1 + (len(documents) - document_frequency + 0.5) / (document_frequency + 0.5))
+        saturation = counts * (k1 + 1) / (counts + k1 * (1 - b + b * lengths / lengths.mean()))
+        self.weights = (saturation * idf).astype(np.float32)
+        self.min_scores = self.weights.sum(axis=1) * np.float32(min_share)
+
+        self.correct = lru_cache(maxsize=4096)(self._correct)
+
+    def _correct(self, token):
+        # Closest vocabulary term within one edit (two for longer words);
+        # short unknown words are left alone rather than guessed at
+        if token in self.vocabulary:
+            return token
+        if len(token) < 4:
+            return None
+        limit = 1 if len(token) < 7 else 2
+        best, best_distance = None, limit + 1
+        for term in self.vocabulary:
+            distance = edit_distance(token, term, limit)
+            if distance < best_distance:
+                best, best_distance = term, distance
+        return best
+
+    def query_vector(self, text, out=None):
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32) if out is None else out
+        for token in tokenize(text):
+            term = self.correct(token)
+            if term is not None:
+                vector[self.vocabulary[term]] = 1
+        return vector
+
+    def disease_scores(self, phrase_scores):
+        # Best relevant phrase per disease; works on one row or a batch of rows
+        phrase_scores = np.where(phrase_scores >= self.min_scores, phrase_scores, 0)
+        return np.maximum.reduceat(phrase_scores, self.starts, axis=-1)
+
+    def top(self, scores, k):
+        # Highest first, ties keep knowledge base order
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [(self.diseases[i], round(float(scores[i]), 3)) for i in order if scores[i] > 0]
+
+    def search(self, text, k=5):
+        return self.top(self.disease_scores(self.weights @ self.query_vector(text)), k)
+
+    def search_batch(self, texts, k=5):
+        queries = np.zeros((len(texts), len(self.vocabulary)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            self.query_vector(text, out=queries[row])
+        scores = self.disease_scores(queries @ self.weights.T)
+        return [self.top(row, k) for row in scores]
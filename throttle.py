@@ -0,0 +1,106 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+# Token buckets for login attempts, shared by every worker process on the
+# host. The buckets live in a fixed-size table in a memory-mapped file
+# (/dev/shm when available): each slot holds an 8-byte hash of the key, the
+# tokens left and when they were last topped up. A check touches a few
+# slots under a file lock, so it is cheap enough to run before any MongoDB
+# lookup or bcrypt verification.
+
+SLOT = struct.Struct('<Qdd')
+PROBES = 8
+
+
+def key_hash(key):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+class Limit:
+    def __init__(self, burst, per_minute):
+        self.burst = float(burst)
+        self.rate = per_minute / 60.0
+
+
+class TokenBucketStore:
+    def __init__(self, path=None, slots=4096):
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.path = path or os.path.join(shm, 'semester1-login-throttle')
+        self.slots = slots
+        self.size = slots * SLOT.size
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # Opened per process (like the MongoDB client) so lockf() locks,
+        # which belong to a process, exclude the other workers
+        if self._pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+            self._map = mmap.mmap(fd, self.size)
+            self._fd = fd
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+
+    def _find(self, digest, now, limit):
+        # Linear probing over a short window. When every probed slot is taken
+        # by another key, reuse the one idle longest: it has refilled the most,
+        # so forgetting it costs the least.
+        start = digest % self.slots
+        victim, victim_updated = None, math.inf
+        for i in range(PROBES):
+            index = (start + i) % self.slots
+            stored, tokens, updated = SLOT.unpack_from(self._map, index * SLOT.size)
+            if stored == digest:
+                return index, tokens, updated
+            if stored == 0:
+                return index, limit.burst, now
+            if updated < victim_updated:
+                victim, victim_updated = index, updated
+        return victim, limit.burst, now
+
+    def take(self, buckets):
+        """Take one token from every (key, Limit) bucket, or from none of them.
+
+        Returns 0 when the attempt may go ahead, otherwise the number of
+        seconds until every bucket has a token again.
+        """
+        now = time.time()
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                found = []
+                wait = 0.0
+                for key, limit in buckets:
+                    digest = key_hash(key)
+                    index, tokens, updated = self._find(digest, now, limit)
+                    tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) / limit.rate if limit.rate else math.inf)
+                    found.append((index, digest, tokens))
+                for index, digest, tokens in found:
+                    SLOT.pack_into(self._map, index * SLOT.size, digest, tokens if wait else tokens - 1, now)
+                return wait
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def clear(self):
+        with self._lock:
+            self._open()
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[:] = bytes(self.size)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
@@ -0,0 +1,346 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from bson import json_util
+
+# Write-behind queue for documents that don't need to be in MongoDB before
+# the response goes out. Callers put() a record and return; a background
+# thread hands them to insert_batch in batches of up to batch_size, as soon
+# as a batch is full or the oldest record has waited flush_interval seconds.
+#
+# A failed batch goes back to the front of the queue and the next attempt
+# takes half as many records, down to one, so a record that can never be
+# written (too large, rejected by validation) is isolated instead of
+# holding up the rest. Once it has failed on its own max_attempts times it
+# is moved to dead_letter_path and handed to on_dead_letter, so the caller
+# can undo whatever it did when the record was queued. Errors listed in
+# `retryable` (a database that is briefly unreachable) never count as
+# attempts.
+#
+# close() (at exit, or from the ASGI lifespan) flushes what it can and
+# appends the rest to spill_path as JSON lines. start() claims that file
+# (and any left by a process that died while replaying one) and queues its
+# records again; the claimed file is only deleted once all of them are
+# written or dead-lettered, or spilled again. A line that can't be parsed
+# goes straight to dead_letter_path; replay() logs errors rather than
+# raising them into worker start-up or put(). Records should carry their
+# own _id so a replayed record that was in fact already written is
+# recognised by insert_batch as a duplicate rather than stored twice.
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    def __init__(self, insert_batch, batch_size=100, flush_interval=0.5, max_pending=10000,
+                 spill_path=None, dead_letter_path=None, max_attempts=5, retryable=(), retry_delay=1.0,
+                 on_dead_letter=None):
+        self.insert_batch = insert_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.spill_path = spill_path
+        self.dead_letter_path = dead_letter_path
+        self.max_attempts = max_attempts
+        self.retryable = tuple(retryable)
+        self.retry_delay = retry_delay
+        self.on_dead_letter = on_dead_letter
+        # Entries are [queued_at, failed_alone, record, claimed spill file or None]
+        self.pending = deque()
+        self.in_flight = 0
+        self.flushed = 0
+        self.failed_flushes = 0
+        self.dead_lettered = 0
+        # Records that will never reach insert_batch: dead-lettered, or
+        # dropped at close without a spill file
+        self.lost = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.last_flush_at = None
+        self.last_error = None
+        self.closed = False
+        self._batch_limit = batch_size
+        self._claims = {}
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        # One flusher thread per process, started by the server's worker
+        # hooks (or on first use) so a forked worker gets its own instead of
+        # the master's, which doesn't survive the fork
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self.pending.clear()
+            self._claims = {}
+            self.in_flight = 0
+            self._batch_limit = self.batch_size
+            self._flush_lock = threading.Lock()
+            self._pid = os.getpid()
+            self.closed = False
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+        self.replay()
+
+    def put(self, record):
+        # False when the queue is full or closed; the caller should then
+        # write the record itself
+        self.start()
+        with self._condition:
+            if self.closed or len(self.pending) >= self.max_pending:
+                return False
+            self._append([time.monotonic(), 0, record, None])
+        return True
+
+    def _append(self, entry):
+        # Caller holds _condition
+        self.pending.append(entry)
+        # Wake the flusher to start the flush_interval clock, or for a full batch
+        if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+            self._condition.notify()
+
+    def _take_batch(self):
+        batch = [self.pending.popleft() for _ in range(min(self._batch_limit, len(self.pending)))]
+        self.in_flight += len(batch)
+        return batch
+
+    def _done(self, entries):
+        # Caller holds _condition; drop claimed spill files nothing is waiting on
+        for entry in entries:
+            claim = entry[3]
+            if claim is not None:
+                self._claims[claim] -= 1
+                if not self._claims[claim]:
+                    del self._claims[claim]
+                    self._remove(claim)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as error:
+            logger.error('Could not remove %s, its records may be replayed again: %s', path, error)
+
+    def _write(self, batch):
+        # Runs under _flush_lock. Returns False when the caller should wait
+        # before trying again, True when it can carry on straight away.
+        try:
+            self.insert_batch([entry[2] for entry in batch])
+        except Exception as error:
+            logger.warning('Write-behind flush of %d records failed: %s', len(batch), error)
+            rejected = not isinstance(error, self.retryable)
+            if rejected and len(batch) == 1:
+                batch[0][1] += 1
+            dead = rejected and len(batch) == 1 and batch[0][1] >= self.max_attempts
+            if dead:
+                self.dead_letter(batch[0], error)
+            with self._condition:
+                self.in_flight -= len(batch)
+                self.failed_flushes += 1
+                self.last_error = f'{type(error).__name__}: {error}'
+                if dead:
+                    self.dead_lettered += 1
+                    self.lost += 1
+                    self._done(batch)
+                else:
+                    self.pending.extendleft(reversed(batch))
+                    if rejected:
+                        self._batch_limit = max(1, len(batch) // 2)
+            # Splitting a batch that was rejected, not unreachable, needs no pause
+            return dead or (rejected and len(batch) > 1)
+        with self._condition:
+            self.in_flight -= len(batch)
+            self.flushed += len(batch)
+            self.last_flush_at = time.time()
+            self._batch_limit = self.batch_size
+            self._done(batch)
+        return True
+
+    def dead_letter(self, entry, error):
+        self._dead_letter_line(json_util.dumps({'record': entry[2], 'error': f'{type(error).__name__}: {error}'}),
+                               f'a record that failed {entry[1]} times')
+        if self.on_dead_letter is not None:
+            try:
+                self.on_dead_letter(entry[2])
+            except Exception as callback_error:
+                logger.error('on_dead_letter failed for a dead-lettered record: %s', callback_error)
+
+    def _dead_letter_line(self, line, what):
+        if self.dead_letter_path:
+            try:
+                self._append_lines(self.dead_letter_path, [line])
+                logger.error('Moved %s to %s', what, self.dead_letter_path)
+                return
+            except OSError as write_error:
+                logger.error('Could not write %s: %s', self.dead_letter_path, write_error)
+        # The log line is then the only copy
+        logger.error('Giving up on %s: %s', what, line)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.closed:
+                    if len(self.pending) >= self._batch_limit:
+                        break
+                    if self.pending:
+                        waited = time.monotonic() - self.pending[0][0]
+                        if waited >= self.flush_interval:
+                            break
+                        self._condition.wait(self.flush_interval - waited)
+                    else:
+                        self._condition.wait()
+                if self.closed:
+                    return
+            with self._flush_lock:
+                with self._condition:
+                    batch = self._take_batch()
+                progressed = not batch or self._write(batch)
+            if not progressed:
+                time.sleep(self.retry_delay)
+
+    def flush(self):
+        # Write everything queued so far from the calling thread; returns
+        # whether the queue was emptied
+        with self._flush_lock:
+            while True:
+                with self._condition:
+                    batch = self._take_batch()
+                if not batch:
+                    return True
+                if not self._write(batch):
+                    return False
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        if not self.flush():
+            self.spill()
+
+    @staticmethod
+    def _append_lines(path, lines):
+        # One fsynced append, so concurrent workers don't interleave records
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def spill(self):
+        with self._condition:
+            entries = list(self.pending)
+            self.pending.clear()
+            claims = list(self._claims)
+            self._claims = {}
+        if not entries:
+            return
+        if not self.spill_path:
+            self.lost += len(entries)
+            logger.error('Dropping %d unwritten records, no spill file configured', len(entries))
+            return
+        self._append_lines(self.spill_path, [json_util.dumps(entry[2]) for entry in entries])
+        # The records from replayed files are in the new spill now
+        for claim in claims:
+            self._remove(claim)
+        self.spilled += len(entries)
+        logger.warning('Spilled %d unwritten records to %s', len(entries), self.spill_path)
+
+    def _orphaned_claims(self):
+        # Files claimed by a process that is gone: spill_path.<pid>[.<n>]
+        for path in glob.glob(glob.escape(self.spill_path) + '.*'):
+            pid = path[len(self.spill_path) + 1:].split('.')[0]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                yield path
+            except PermissionError:
+                pass
+
+    def replay(self):
+        # Claim spilled files by renaming them, so only one worker replays
+        # each, and queue their records ahead of new ones
+        if not self.spill_path:
+            return 0
+        replayed = 0
+        try:
+            sources = [self.spill_path, *self._orphaned_claims()]
+        except OSError as error:
+            logger.error('Could not look for spilled records: %s', error)
+            return 0
+        for source in sources:
+            claimed = f'{self.spill_path}.{os.getpid()}.{time.monotonic_ns()}'
+            try:
+                os.rename(source, claimed)
+                records = self._read_spill(claimed)
+            except FileNotFoundError:
+                continue
+            except OSError as error:
+                # Left for the next worker to start (or an admin) to retry
+                logger.error('Could not replay %s: %s', source, error)
+                continue
+            if not records:
+                self._remove(claimed)
+                continue
+            with self._condition:
+                self._claims[claimed] = len(records)
+                now = time.monotonic()
+                self.pending.extendleft(reversed([[now, 0, record, claimed] for record in records]))
+                self.replayed += len(records)
+                self._condition.notify()
+            replayed += len(records)
+            logger.info('Queued %d records spilled by an earlier process', len(records))
+        return replayed
+
+    def _read_spill(self, path):
+        # Parsed line by line; one a crash cut short, or any other that
+        # doesn't parse, is dead-lettered instead of failing the whole file
+        records = []
+        with open(path, encoding='utf-8', errors='replace') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json_util.loads(line))
+                except Exception as error:
+                    self._dead_letter_line(json.dumps({'line': line.rstrip('\n'), 'error': f'{error}'}),
+                                           f'unreadable line {number} of {path}')
+                    with self._condition:
+                        self.dead_lettered += 1
+                        self.lost += 1
+        return records
+
+    def status(self):
+        with self._condition:
+            return {
+                'pending': len(self.pending),
+                'in_flight': self.in_flight,
+                'oldest_pending_seconds': round(time.monotonic() - self.pending[0][0], 3) if self.pending else None,
+                'flushed': self.flushed,
+                'failed_flushes': self.failed_flushes,
+                'dead_lettered': self.dead_lettered,
+                'lost': self.lost,
+                'last_flush_at': self.last_flush_at,
+                'last_error': self.last_error,
+                'spilled': self.spilled,
+                'replayed': self.replayed,
+                'unreplayed_files': len(self._claims),
+                'batch_size': self.batch_size,
+                'flush_interval': self.flush_interval,
+                'closed': self.closed,
+            }